@@ -0,0 +1,266 @@
+"""
+Replays a reproducible query mix against a local server answering from a synthetic zone set.
+The server is started on a free port with an in-memory store, ALIAS targets are answered by a stub
+upstream, and the throughput, latency percentiles and server CPU time per query are reported.
+Usage: python benchmark/load.py [--help] [options]
+"""
+import os, sys, json, time, struct, socket, random, argparse, tempfile, threading, subprocess
+import dnslib
+from zones import generate
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server", "main.py")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay a query mix against a local server.")
+    parser.add_argument("--queries", type=int, default=20000, help="queries to send and measure")
+    parser.add_argument("--warmup", type=int, default=2000, help="queries to send before measuring")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients, each waits for its answer")
+    parser.add_argument("--zones", type=int, default=100, help="zones in the synthetic zone set")
+    parser.add_argument("--hosts", type=int, default=20, help="A/AAAA hosts in each zone")
+    parser.add_argument("--zipf", type=float, default=1.0, help="Zipf exponent of query popularity, 0 is uniform")
+    parser.add_argument("--nxdomain", type=float, default=0.05, help="share of queries for missing names")
+    parser.add_argument("--edns", type=float, default=0.8, help="share of queries carrying an EDNS OPT record")
+    parser.add_argument("--tcp", type=float, default=0.05, help="share of queries sent over TCP")
+    parser.add_argument("--timeout", type=float, default=2, help="seconds to wait for each answer")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the zones and query mix")
+    parser.add_argument("--server", help="address:port of an already running server to query instead")
+    return parser.parse_args()
+
+
+def build_queries(args, queries, count, rng):
+    """
+    Draw a query mix.
+    :param args: Parsed arguments.
+    :param queries: List of (domain, qtype) pairs with answers.
+    :param count: Number of queries to draw.
+    :param rng: Random number generator.
+    :return: List of (packet, tcp) tuples.
+    """
+    ranked = list(queries)
+    rng.shuffle(ranked) # Spread the popular names over every zone and record type.
+    weights, total = [], 0.0
+    for rank in range(len(ranked)):
+        total += 1 / (rank + 1) ** args.zipf
+        weights.append(total)
+    picks = rng.choices(ranked, cum_weights=weights, k=count)
+    mix = []
+    for index, (domain, q_type) in enumerate(picks):
+        if rng.random() < args.nxdomain:
+            domain = "nx%08x.zone%d.com." % (rng.getrandbits(32), rng.randrange(args.zones))
+        question = dnslib.DNSRecord.question(domain, q_type)
+        question.header.id = index % 65536
+        if rng.random() < args.edns:
+            question.add_ar(dnslib.EDNS0(udp_len=1232))
+        mix.append((question.pack(), rng.random() < args.tcp))
+    return mix
+
+
+def alias_upstream():
+    """
+    Start a stub upstream resolver answering every A/AAAA question with a fixed address.
+    :return: Address of the stub.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+
+    def answer():
+        while True:
+            data, client = sock.recvfrom(4096)
+            request = dnslib.DNSRecord.parse(data)
+            reply = request.reply()
+            if request.q.qtype == dnslib.QTYPE.A:
+                reply.add_answer(dnslib.RR(request.q.qname, dnslib.QTYPE.A, rdata=dnslib.A("203.0.113.1"), ttl=60))
+            elif request.q.qtype == dnslib.QTYPE.AAAA:
+                reply.add_answer(dnslib.RR(request.q.qname, dnslib.QTYPE.AAAA,
+                                           rdata=dnslib.AAAA("2001:db8:ffff::1"), ttl=60))
+            sock.sendto(reply.pack(), client)
+    threading.Thread(target=answer, daemon=True).start()
+    return sock.getsockname()
+
+
+def free_port():
+    """
+    Find a port free for both UDP and TCP.
+    """
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+            udp.bind(("127.0.0.1", 0))
+            port = udp.getsockname()[1]
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp:
+                try:
+                    tcp.bind(("127.0.0.1", port))
+                    return port
+                except OSError:
+                    continue
+
+
+def start_server(args, records):
+    """
+    Start the server in a subprocess answering from the records.
+    :return: Tuple of the process, its address and the zone file to remove afterwards.
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+        json.dump(records, file)
+    upstream = alias_upstream()
+    port = free_port()
+    env = dict(os.environ, DNS_STORE="memory", DNS_STORE_PATH=file.name, DNS_ADDRESS="127.0.0.1",
+               DNS_PORT=str(port), DNS_ALIAS_UPSTREAM="%s:%d" % upstream)
+    process = subprocess.Popen([sys.executable, SERVER], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    address = ("127.0.0.1", port)
+    probe = dnslib.DNSRecord.question(records[0]["domain"], "SOA").pack()
+    deadline = time.monotonic() + 30
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        while True:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                sys.exit("Server failed to start")
+            try:
+                sock.sendto(probe, address)
+                sock.recv(4096)
+                return process, address, file.name
+            except OSError:
+                pass
+
+
+def cpu_seconds(pid):
+    """
+    Read the CPU time used by a process and its direct children (worker processes) from /proc.
+    :return: Seconds of user and system time, or None where /proc is unavailable.
+    """
+    total = 0
+    try:
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open("/proc/" + entry + "/stat") as file:
+                    fields = file.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            if int(entry) == pid or int(fields[1]) == pid:
+                total += int(fields[11]) + int(fields[12]) # utime and stime.
+    except OSError:
+        return None
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+class Client(threading.Thread):
+    """
+    Closed loop client sending its queries one at a time over UDP or a persistent TCP connection.
+    """
+
+    def __init__(self, address, mix, timeout):
+        super().__init__(daemon=True)
+        self.address = address
+        self.mix = mix
+        self.timeout = timeout
+        self.latencies = []
+        self.lost = 0
+        self.truncated = 0
+        self.empty = 0
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.settimeout(timeout)
+        self._tcp = None
+
+    def run(self):
+        for packet, tcp in self.mix:
+            started = time.perf_counter()
+            try:
+                reply = self._ask_tcp(packet) if tcp else self._ask_udp(packet)
+            except OSError:
+                self.lost += 1
+                if tcp and self._tcp is not None:
+                    self._tcp.close()
+                    self._tcp = None
+                continue
+            self.latencies.append(time.perf_counter() - started)
+            if reply[2] & 0x02:
+                self.truncated += 1
+            if reply[6:8] == b"\x00\x00": # No answer records.
+                self.empty += 1
+        self._udp.close()
+        if self._tcp is not None:
+            self._tcp.close()
+
+    def _ask_udp(self, packet):
+        self._udp.sendto(packet, self.address)
+        while True:
+            reply = self._udp.recv(65535)
+            if reply[:2] == packet[:2]: # Skip late answers to earlier, timed out queries.
+                return reply
+
+    def _ask_tcp(self, packet):
+        if self._tcp is None:
+            self._tcp = socket.create_connection(self.address, timeout=self.timeout)
+        self._tcp.sendall(struct.pack(">H", len(packet)) + packet)
+        length = struct.unpack(">H", self._receive(2))[0]
+        return self._receive(length)
+
+    def _receive(self, length):
+        data = b""
+        while len(data) < length:
+            chunk = self._tcp.recv(length - len(data))
+            if not chunk:
+                raise ConnectionError("Server closed the connection")
+            data += chunk
+        return data
+
+
+def replay(address, mix, clients, timeout):
+    """
+    Send a query mix split between concurrent clients.
+    :return: Tuple of the finished clients and the elapsed wall clock time.
+    """
+    workers = [Client(address, mix[index::clients], timeout) for index in range(clients)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return workers, time.perf_counter() - started
+
+
+def percentile(latencies, fraction):
+    """
+    Exact percentile of sorted latencies.
+    """
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = random.Random(args.seed)
+    records, queries = generate(args.zones, args.hosts, args.seed)
+    warmup = build_queries(args, queries, args.warmup, rng)
+    mix = build_queries(args, queries, args.queries, rng)
+    process, zone_file = None, None
+    if args.server:
+        host, port = args.server.rsplit(":", 1)
+        address = (host, int(port))
+    else:
+        process, address, zone_file = start_server(args, records)
+    try:
+        replay(address, warmup, args.clients, args.timeout)
+        cpu_before = cpu_seconds(process.pid) if process else None
+        workers, elapsed = replay(address, mix, args.clients, args.timeout)
+        cpu_after = cpu_seconds(process.pid) if process else None
+    finally:
+        if process is not None:
+            process.kill()
+            process.wait()
+            os.remove(zone_file)
+    latencies = sorted(latency for worker in workers for latency in worker.latencies)
+    print("records:     %d in %d zones" % (len(records), args.zones))
+    print("queries:     %d (%d lost, %d truncated, %d without answers)" % (
+        len(mix), sum(worker.lost for worker in workers), sum(worker.truncated for worker in workers),
+        sum(worker.empty for worker in workers)))
+    print("throughput:  %.0f qps" % (len(latencies) / elapsed))
+    for name, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+        print("%-12s %.1f us" % (name + ":", percentile(latencies, fraction) * 1e6))
+    if cpu_before is not None and cpu_after is not None and latencies:
+        print("server cpu:  %.1f us/query" % ((cpu_after - cpu_before) / len(latencies) * 1e6))
@@ -0,0 +1,74 @@
+"""
+Microbenchmarks of the response building functions against the synthetic zone set.
+Every lookup is served from warm caches, so only the cost of building records is measured.
+Usage: python benchmark/micro.py [calls per measurement]
+"""
+import os, sys, time, timeit, logging
+
+os.environ.setdefault("DNS_STORE", "memory")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+import dnslib, search, main
+from store import MemoryStore
+from zones import generate, ALIAS_TARGET
+
+QTYPE = dnslib.QTYPE
+
+
+def measure(function, calls):
+    """
+    Time a function, keeping the fastest of several runs.
+    :return: Microseconds per call.
+    """
+    return min(timeit.repeat(function, number=calls, repeat=5)) / calls * 1e6
+
+
+if __name__ == '__main__':
+    logging.getLogger("DNS").setLevel(logging.WARNING)
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    records, _ = generate(zones=1, hosts=1)
+    search.store = MemoryStore(records)
+    for q_type in (QTYPE.A, QTYPE.AAAA):
+        search.alias_resolver.cache.put((ALIAS_TARGET, q_type), (["203.0.113.1"] if q_type == QTYPE.A else
+                                                                  ["2001:db8:ffff::1"], time.monotonic() + 3600), 3600)
+    by_name = {record["domain"]: record for record in records}
+    apex = records[0]["domain"]
+    apex_record = by_name[apex]
+    www_record = by_name["www." + apex]
+    srv_record = by_name["_sip._tcp." + apex]
+    naptr_record = by_name["sip." + apex]
+    alias_record = by_name["cdn." + apex]
+    handler = main.TransportHandler(address=("127.0.0.1", 0))
+    empty = lambda: ([], [], [])
+
+    helpers = [
+        ("_a_search", lambda: search._a_search(apex_record, *empty())),
+        ("_aaaa_search", lambda: search._aaaa_search(apex_record, *empty())),
+        ("_cname_search", lambda: search._cname_search(www_record, *empty())),
+        ("_ns_search", lambda: search._ns_search(apex_record, [], [])),
+        ("_mx_search", lambda: search._mx_search(apex_record, *empty())),
+        ("_soa_search", lambda: search._soa_search(apex_record, *empty(), authority=False)),
+        ("_txt_search", lambda: search._txt_search(apex_record, *empty())),
+        ("_srv_search", lambda: search._srv_search(srv_record, *empty())),
+        ("_caa_search", lambda: search._caa_search(apex_record, *empty())),
+        ("_naptr_search", lambda: search._naptr_search(naptr_record, *empty())),
+        ("_alias_search", lambda: search._alias_search(QTYPE.A, alias_record, *empty())),
+    ]
+    identify = [(apex_record, QTYPE.A), (apex_record, QTYPE.MX), (apex_record, QTYPE.ANY), (www_record, QTYPE.A),
+                (srv_record, QTYPE.SRV), (naptr_record, QTYPE.NAPTR), (alias_record, QTYPE.AAAA),
+                (srv_record, QTYPE.A)]
+    responses = [(apex, "A"), (apex, "MX"), (apex, "ANY"), ("www." + apex, "A"), ("cdn." + apex, "A"),
+                 ("_sip._tcp." + apex, "SRV"), ("missing." + apex, "A")]
+
+    for name, function in helpers:
+        function() # Warm the record cache.
+        print("%-34s %8.1f us" % (name, measure(function, calls)))
+    for record, q_type in identify:
+        search._identify_record(record, q_type)
+        print("%-34s %8.1f us" % ("_identify_record %s %s" % (record["domain"].split(".")[0], QTYPE[q_type]),
+                                  measure(lambda: search._identify_record(record, q_type), calls)))
+    for domain, q_type in responses:
+        request = dnslib.DNSRecord.question(domain, q_type)
+        handler._build_response(request)
+        print("%-34s %8.1f us" % ("_build_response %s %s" % (domain.split(".")[0], q_type),
+                                  measure(lambda: handler._build_response(request), calls)))
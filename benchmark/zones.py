@@ -0,0 +1,63 @@
+"""
+Generates a synthetic zone set in the records table format, together with the queries it can answer.
+Usage: python benchmark/zones.py <records.json> [zones] [hosts per zone]
+"""
+import sys, json, random
+
+# Every ALIAS record points at this name, answered by the stub upstream of the load generator.
+ALIAS_TARGET = "alias-target.example.net."
+
+
+def generate(zones=100, hosts=20, seed=1):
+    """
+    Generate records for a number of zones.
+    :param zones: Number of zones.
+    :param hosts: Number of A/AAAA hosts in each zone.
+    :param seed: Random seed, the same seed always gives the same zones.
+    :return: Tuple of the list of records and the list of (domain, qtype) pairs with answers.
+    """
+    rng = random.Random(seed)
+    records, queries = [], []
+
+    def add(record, *qtypes):
+        record["live"] = True
+        records.append(record)
+        queries.extend((record["domain"], qtype) for qtype in qtypes)
+
+    for zone in range(zones):
+        apex = "zone%d.com." % zone
+        add({"domain": apex,
+             "SOA": {"ttl": 3600, "mname": "ns1.uh-dns.com.", "rname": "hostmaster." + apex,
+                     "times": [zone + 1, 7200, 3600, 1209600, 300]},
+             "NS": {"ttl": 3600, "value": ["ns1.uh-dns.com.", "ns2.uh-dns.com."]},
+             "A": {"ttl": 300, "value": ["192.0.2.%d" % (zone % 254 + 1)]},
+             "AAAA": {"ttl": 300, "value": ["2001:db8::%x" % (zone + 1)]},
+             "MX": {"ttl": 300, "value": [{"domain": "mail." + apex, "preference": 10},
+                                          {"domain": "mail2." + apex, "preference": 20}]},
+             "TXT": {"ttl": 300, "value": ["v=spf1 mx -all", "bench-verification=%08x" % rng.getrandbits(32)]},
+             "CAA": {"ttl": 300, "value": [{"flags": 0, "tag": "issue", "value": "letsencrypt.org"}]}},
+            "A", "AAAA", "MX", "TXT", "CAA", "SOA", "NS", "ANY")
+        add({"domain": "www." + apex, "CNAME": {"ttl": 300, "domain": apex}}, "A", "AAAA")
+        add({"domain": "_sip._tcp." + apex,
+             "SRV": {"ttl": 300, "value": [{"priority": 10, "weight": 60, "port": 5060, "target": "sip." + apex}]}},
+            "SRV")
+        add({"domain": "sip." + apex,
+             "NAPTR": {"ttl": 300, "value": [{"order": 100, "preference": 10, "flags": "S", "service": "SIP+D2U",
+                                              "regexp": "", "replacement": "_sip._udp." + apex}]}},
+            "NAPTR")
+        add({"domain": "cdn." + apex, "ALIAS": {"ttl": 60, "domain": ALIAS_TARGET}}, "A", "AAAA")
+        for host in range(hosts):
+            add({"domain": "host%d.%s" % (host, apex),
+                 "A": {"ttl": 300, "value": ["198.51.100.%d" % rng.randint(1, 254)]},
+                 "AAAA": {"ttl": 300, "value": ["2001:db8:%x::%x" % (zone + 1, host + 1)]}},
+                "A", "AAAA")
+    return records, queries
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(__doc__.strip())
+    records, _ = generate(*[int(arg) for arg in sys.argv[2:4]])
+    with open(sys.argv[1], "w") as file:
+        json.dump(records, file)
+    print("Wrote " + str(len(records)) + " records to " + sys.argv[1])
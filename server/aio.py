@@ -0,0 +1,212 @@
+import asyncio, struct, logging, metrics
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("DNS")
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram protocol handing each DNS query to the async serving core.
+    """
+
+    def __init__(self, server):
+        """
+        Constructor for the UDP protocol class.
+        :param server: AsyncTransportHandler serving the queries.
+        """
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, client):
+        answer, response = self.server.handler._rate_limit(data, client)
+        if answer:
+            self.server.submit(self.server.respond_udp(self.transport, data, client))
+        elif response is not None:
+            self.transport.sendto(response, client)
+
+
+class AsyncTransportHandler():
+    """
+    Class to serve DNS requests from an asyncio event loop.
+    Blocking lookups run on a fixed size executor and the number of requests in flight is bounded.
+    TCP connections are persistent and pipelined as per RFC 7766.
+    """
+
+    def __init__(self, handler, workers=32, max_inflight=1024, max_connections=256, max_pipeline=16,
+                 idle_timeout=10):
+        """
+        Constructor for the async transport handler class.
+        :param handler: TransportHandler owning the sockets and building responses.
+        :param workers: Number of executor threads used for blocking lookups.
+        :param max_inflight: Maximum number of UDP requests being served at once, extra queries are dropped.
+        :param max_connections: Maximum number of open TCP connections, extra connections are closed.
+        :param max_pipeline: Maximum number of queries answered at once on a single TCP connection.
+        :param idle_timeout: Seconds a TCP connection may stay idle before it is closed.
+        """
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_inflight = max_inflight
+        self.max_connections = max_connections
+        self.max_pipeline = max_pipeline
+        self.idle_timeout = idle_timeout
+        self.inflight = 0
+        self.connections = 0
+        self.dropped = 0
+        self.loop = None
+
+    def submit(self, coroutine):
+        """
+        Schedule a request coroutine if below the in-flight limit.
+        :param coroutine: Request coroutine to run.
+        :return: Whether the request was accepted.
+        """
+        if self.inflight >= self.max_inflight:
+            coroutine.close()
+            self.dropped += 1
+            return False
+        self.inflight += 1
+        self.loop.create_task(coroutine).add_done_callback(self._done)
+        return True
+
+    def _done(self, task):
+        """
+        Release the in-flight slot of a finished request.
+        :param task: Finished request task.
+        """
+        self.inflight -= 1
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Request failed", exc_info=task.exception())
+
+    async def _build(self, data, client, tcp=False):
+        """
+        Build and pack the response for a query on the executor.
+        :param data: binary data in the form of a DNS query.
+        :param client: client address.
+        :param tcp: Whether the query arrived over TCP.
+        :return: Packed DNS response.
+        """
+        return await self.loop.run_in_executor(self.executor, self.handler._build_packet, data, tcp, client)
+
+    async def respond_udp(self, transport, data, client):
+        """
+        Answer a single UDP query.
+        :param transport: Datagram transport to reply on.
+        :param data: incoming binary data to parse.
+        :param client: client address.
+        """
+        response = await self._build(data, client)
+        if response is not None:
+            started = perf_counter()
+            transport.sendto(response, client)
+            metrics.stage("sendto", started, perf_counter())
+
+    async def _tcp_connection(self, reader, writer):
+        """
+        Serve a TCP connection as per RFC 7766: length prefixed queries are read incrementally,
+        the connection is kept open until idle and pipelined queries are answered as soon as
+        each is ready, possibly out of order.
+        :param reader: Stream reader for the connection.
+        :param writer: Stream writer for the connection.
+        """
+        if self.connections >= self.max_connections:
+            writer.close()
+            return
+        self.connections += 1
+        client = writer.get_extra_info("peername")
+        pending = set()
+        lock = asyncio.Lock()
+        try:
+            while True:
+                try:
+                    length = struct.unpack(">H", await asyncio.wait_for(reader.readexactly(2), self.idle_timeout))[0]
+                    data = await asyncio.wait_for(reader.readexactly(length), self.idle_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                task = self.loop.create_task(self._tcp_answer(writer, lock, data, client))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                if len(pending) >= self.max_pipeline:
+                    await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _tcp_answer(self, writer, lock, data, client):
+        """
+        Answer a single query received on a TCP connection.
+        :param writer: Stream writer for the connection.
+        :param lock: Lock serialising writes to the connection.
+        :param data: incoming binary data to parse.
+        :param client: client address.
+        """
+        transfer = self.handler.transfer
+        messages = transfer.messages(data, client) if transfer is not None else None
+        if messages is not None:
+            await self._tcp_transfer(writer, lock, messages)
+            return
+        response = await self._build(data, client, tcp=True)
+        if response is None:
+            return
+        async with lock:
+            try:
+                writer.write(struct.pack(">H", len(response)) + response)
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def _tcp_transfer(self, writer, lock, messages):
+        """
+        Stream the messages of a zone transfer, each produced on the executor and written as soon
+        as it is ready. The connection is held for the whole transfer so no other response interleaves.
+        If the transfer fails part way the connection is closed, so the client sees it was cut short.
+        :param writer: Stream writer for the connection.
+        :param lock: Lock serialising writes to the connection.
+        :param messages: Generator of packed messages.
+        """
+        async with lock:
+            while True:
+                try:
+                    message = await self.loop.run_in_executor(self.executor, next, messages, None)
+                except Exception:
+                    logger.exception("Zone transfer failed")
+                    writer.close()
+                    return
+                if message is None:
+                    return
+                try:
+                    writer.write(struct.pack(">H", len(message)) + message)
+                    await writer.drain()
+                except ConnectionError:
+                    return
+
+    async def serve(self, udp=True, tcp=True):
+        """
+        Serve queries on the handler sockets forever.
+        :param udp: Serve UDP queries.
+        :param tcp: Serve TCP connections.
+        """
+        self.loop = asyncio.get_running_loop()
+        if udp:
+            self.handler.udp_sock.setblocking(False)
+            await self.loop.create_datagram_endpoint(lambda: _UDPProtocol(self), sock=self.handler.udp_sock)
+        if tcp:
+            self.handler.tcp_sock.setblocking(False)
+            server = await asyncio.start_server(self._tcp_connection, sock=self.handler.tcp_sock)
+            async with server:
+                await server.serve_forever()
+        else:
+            await self.loop.create_future()
+
+    def run(self, udp=True, tcp=True):
+        """
+        Run the serving core until interrupted.
+        :param udp: Serve UDP queries.
+        :param tcp: Serve TCP connections.
+        """
+        asyncio.run(self.serve(udp=udp, tcp=tcp))
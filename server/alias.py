@@ -0,0 +1,154 @@
+import socket, queue, random, time, threading, logging, dnslib, metrics
+from cache import TTLCache
+from singleflight import SingleFlight
+
+logger = logging.getLogger("DNS")
+
+
+class AliasResolver():
+    """
+    Class to resolve ALIAS targets against the upstream resolver.
+    Answers are cached for min(upstream TTL, ALIAS TTL), concurrent identical lookups share
+    one upstream query and sockets are kept open and reused between queries.
+    """
+
+    def __init__(self, upstream=("10.0.0.2", 53), timeout=1, pool_size=16, cache_entries=10000, prefetch=0):
+        """
+        Constructor for the ALIAS resolver class.
+        :param upstream: Address of the upstream resolver.
+        :param timeout: Seconds to wait for an upstream answer.
+        :param pool_size: Maximum number of idle sockets kept open.
+        :param cache_entries: Maximum number of upstream answers cached.
+        :param prefetch: Refresh cached answers in the background when a hit is this many seconds
+        from expiring (0 disables prefetching).
+        """
+        self.upstream = upstream
+        self.timeout = timeout
+        self.prefetch = prefetch
+        self.cache = TTLCache(max_entries=cache_entries or None)
+        self.flights = SingleFlight()
+        self._sockets = queue.LifoQueue(maxsize=pool_size)
+        self._prefetching = set()
+        self._lock = threading.Lock()
+
+    def resolve(self, domain, q_type, ttl):
+        """
+        Find the addresses of an ALIAS target.
+        :param domain: Target domain of the ALIAS record.
+        :param q_type: Query type (A or AAAA).
+        :param ttl: TTL of the ALIAS record, the longest time an answer is cached for.
+        :return: Tuple of the list of address strings and the TTL to answer with,
+        min(upstream TTL, ALIAS TTL) counting down while the answer is cached.
+        """
+        key = (domain.lower(), q_type)
+        found, entry = self.cache.get(key)
+        if found:
+            addresses, expires = entry
+            remaining = expires - time.monotonic()
+            if self.prefetch and remaining < self.prefetch:
+                self._prefetch(key, ttl)
+            return addresses, max(int(remaining), 0)
+        return self.flights.do(key, lambda: self._fetch(key, ttl), timeout=self.timeout)
+
+    def _fetch(self, key, ttl):
+        """
+        Query the upstream resolver and cache its answer.
+        :param key: Tuple of target domain and query type.
+        :param ttl: TTL of the ALIAS record.
+        :return: Tuple of the list of address strings and the TTL they are cached for.
+        """
+        domain, q_type = key
+        started = time.perf_counter()
+        response = self._query(domain, q_type)
+        metrics.stage("alias", started, time.perf_counter())
+        answers = [rr for rr in response.rr if rr.rtype == q_type]
+        ttl = min([ttl] + [rr.ttl for rr in answers])
+        addresses = [str(rr.rdata) for rr in answers]
+        self.cache.put(key, (addresses, time.monotonic() + ttl), ttl)
+        return addresses, ttl
+
+    def _prefetch(self, key, ttl):
+        """
+        Refresh a cached answer in the background, at most once at a time per key.
+        :param key: Tuple of target domain and query type.
+        :param ttl: TTL of the ALIAS record.
+        """
+        with self._lock:
+            if key in self._prefetching:
+                return
+            self._prefetching.add(key)
+
+        def refresh():
+            try:
+                self.flights.do(key, lambda: self._fetch(key, ttl), timeout=self.timeout)
+            except Exception:
+                logger.warning("ALIAS prefetch failed for " + key[0])
+            finally:
+                with self._lock:
+                    self._prefetching.discard(key)
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _query(self, domain, q_type):
+        """
+        Send a question upstream, ignoring any reply not matching its ID and question.
+        :param domain: Domain to query.
+        :param q_type: Query type.
+        :return: Parsed upstream response.
+        :raises socket.timeout: If no matching reply arrives in time.
+        """
+        question = dnslib.DNSRecord.question(domain, qtype=dnslib.QTYPE[q_type])
+        question.header.id = random.getrandbits(16)
+        sock = self._acquire()
+        try:
+            sock.send(question.pack())
+            deadline = time.monotonic() + self.timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("ALIAS upstream timed out")
+                sock.settimeout(remaining)
+                reply = sock.recv(4096)
+                try:
+                    response = dnslib.DNSRecord.parse(reply)
+                except dnslib.DNSError:
+                    continue
+                if response.header.id == question.header.id and response.questions == question.questions:
+                    self._release(sock)
+                    return response
+        except Exception:
+            sock.close()
+            raise
+
+    def _acquire(self):
+        """
+        Take an idle socket from the pool or open a new one.
+        :return: UDP socket connected to the upstream resolver.
+        """
+        try:
+            return self._sockets.get_nowait()
+        except queue.Empty:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("", 0)) # Bind to any available IP and port.
+            sock.connect(self.upstream)
+            return sock
+
+    def _release(self, sock):
+        """
+        Return a socket to the pool, closing it if the pool is full.
+        :param sock: Socket to return.
+        """
+        try:
+            self._sockets.put_nowait(sock)
+        except queue.Full:
+            sock.close()
+
+    def close(self):
+        """
+        Close every idle socket, e.g. the ones inherited from the parent of a forked process,
+        which would otherwise receive the replies to other processes' queries.
+        """
+        while True:
+            try:
+                self._sockets.get_nowait().close()
+            except queue.Empty:
+                return
@@ -0,0 +1,167 @@
+"""
+Batched I/O on a non-blocking UDP socket.
+Datagrams are received into preallocated buffers and handed out as memoryviews, so nothing is
+allocated per packet, and replies are sent together. Where the Linux recvmmsg and sendmmsg system
+calls are available they are called through ctypes to move a whole batch in a single system call.
+"""
+import errno, socket, struct, ctypes, ctypes.util
+
+_SOCKADDR_IN = struct.Struct("=H")
+_PORT = struct.Struct(">H")
+MSG_DONTWAIT = 0x40
+
+
+class BatchSocket():
+    """
+    Class to receive and send batches of datagrams with recvfrom_into and sendto.
+    """
+
+    def __init__(self, sock, batch=64, size=8192):
+        """
+        Constructor for the batch socket class.
+        :param sock: Non-blocking UDP socket.
+        :param batch: Maximum number of datagrams received at once.
+        :param size: Size of each receive buffer.
+        """
+        self.sock = sock
+        self.batch = batch
+        self.size = size
+        self.buffers = [bytearray(size) for _ in range(batch)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+
+    def recv(self):
+        """
+        Receive every pending datagram up to the batch size.
+        The views are only valid until the next call.
+        :return: List of (memoryview, client address) tuples, empty when nothing is pending.
+        """
+        datagrams = []
+        for view in self.views:
+            try:
+                length, client = self.sock.recvfrom_into(view)
+            except (BlockingIOError, InterruptedError):
+                break
+            datagrams.append((view[:length], client))
+        return datagrams
+
+    def send(self, replies):
+        """
+        Send replies, dropping any the socket buffer has no room for.
+        :param replies: List of (packet, client address) tuples.
+        :return: Number of replies sent.
+        """
+        sent = 0
+        for packet, client in replies:
+            try:
+                self.sock.sendto(packet, client)
+                sent += 1
+            except (BlockingIOError, InterruptedError):
+                pass
+        return sent
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_libc():
+    """
+    Load libc if it provides recvmmsg and sendmmsg.
+    :return: libc or None.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError, TypeError):
+        return None
+
+
+_libc = _load_libc()
+
+
+class MMsgSocket(BatchSocket):
+    """
+    Class to receive and send batches of IPv4 datagrams with one recvmmsg or sendmmsg call each.
+    """
+
+    def __init__(self, sock, batch=64, size=8192):
+        super().__init__(sock, batch, size)
+        self._fd = sock.fileno()
+        self._recv_iov = (_iovec * batch)()
+        self._recv_names = (ctypes.c_ubyte * (16 * batch))()
+        self._recv = (_mmsghdr * batch)()
+        for index, buffer in enumerate(self.buffers):
+            self._recv_iov[index].iov_base = ctypes.addressof((ctypes.c_char * size).from_buffer(buffer))
+            self._recv_iov[index].iov_len = size
+            self._recv[index].msg_hdr.msg_name = ctypes.addressof(self._recv_names) + 16 * index
+            self._recv[index].msg_hdr.msg_iov = ctypes.pointer(self._recv_iov[index])
+            self._recv[index].msg_hdr.msg_iovlen = 1
+        self._send_iov = (_iovec * batch)()
+        self._send_names = (ctypes.c_ubyte * (16 * batch))()
+        self._send = (_mmsghdr * batch)()
+        for index in range(batch):
+            self._send[index].msg_hdr.msg_name = ctypes.addressof(self._send_names) + 16 * index
+            self._send[index].msg_hdr.msg_namelen = 16
+            self._send[index].msg_hdr.msg_iov = ctypes.pointer(self._send_iov[index])
+            self._send[index].msg_hdr.msg_iovlen = 1
+
+    def recv(self):
+        names = memoryview(self._recv_names)
+        for index in range(self.batch):
+            self._recv[index].msg_hdr.msg_namelen = 16
+        count = _libc.recvmmsg(self._fd, self._recv, self.batch, MSG_DONTWAIT, None)
+        if count < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise OSError(error, "recvmmsg failed")
+        datagrams = []
+        for index in range(count):
+            name = names[16 * index:16 * index + 8]
+            client = (socket.inet_ntoa(name[4:8]), _PORT.unpack_from(name, 2)[0])
+            datagrams.append((self.views[index][:self._recv[index].msg_len], client))
+        return datagrams
+
+    def send(self, replies):
+        done, sent = 0, 0
+        while done < len(replies):
+            chunk = replies[done:done + self.batch]
+            for index, (packet, client) in enumerate(chunk):
+                self._send_iov[index].iov_base = ctypes.cast(ctypes.c_char_p(packet), ctypes.c_void_p)
+                self._send_iov[index].iov_len = len(packet)
+                offset = 16 * index
+                self._send_names[offset:offset + 8] = _SOCKADDR_IN.pack(socket.AF_INET) + \
+                    _PORT.pack(client[1]) + socket.inet_aton(client[0])
+            count = _libc.sendmmsg(self._fd, self._send, len(chunk), MSG_DONTWAIT)
+            if count < 0 and ctypes.get_errno() in (errno.EAGAIN, errno.EINTR):
+                break # Socket buffer full, drop the remaining replies.
+            sent += max(count, 0)
+            # Skip a reply the kernel refused so the rest are still sent.
+            done += count if count > 0 else 1
+        return sent
+
+
+def open_batch_socket(sock, batch=64, mmsg=True):
+    """
+    Wrap a non-blocking UDP socket for batched I/O.
+    :param sock: Non-blocking UDP socket.
+    :param batch: Maximum number of datagrams received or sent at once.
+    :param mmsg: Use recvmmsg and sendmmsg where available.
+    :return: BatchSocket or MMsgSocket.
+    """
+    if mmsg and _libc is not None and sock.family == socket.AF_INET:
+        return MMsgSocket(sock, batch)
+    return BatchSocket(sock, batch)
@@ -0,0 +1,139 @@
+import threading, time
+from collections import OrderedDict
+
+
+class TTLCache():
+    """
+    Thread safe LRU cache where every entry carries its own time to live.
+    The cache can be bounded by number of entries, by approximate size in bytes or both.
+    Expired entries can be kept for a stale window, where only peek still returns them.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None, stale=0):
+        """
+        Constructor for the TTL cache class.
+        :param max_entries: Maximum number of entries to hold (None for unbounded).
+        :param max_bytes: Maximum approximate size of all values in bytes (None for unbounded).
+        :param sizeof: Function returning the approximate size of a value in bytes.
+        :param stale: Seconds to keep entries for after they expire.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale = stale
+        self.sizeof = sizeof or (lambda value: len(repr(value)))
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Fetch a live entry from the cache, marking it as most recently used.
+        :param key: Key to look up.
+        :return: Tuple of whether the key was found and its value.
+        """
+        with self._lock:
+            try:
+                expires, value, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+            now = time.monotonic()
+            if expires <= now:
+                if expires + self.stale <= now:
+                    self._remove(key)
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def peek(self, key):
+        """
+        Fetch an entry, including one expired within the stale window, without counting a hit or miss.
+        :param key: Key to look up.
+        :return: Tuple of whether the key was found, its value and the seconds until it expires
+        (negative once expired).
+        """
+        with self._lock:
+            try:
+                expires, value, size = self._entries[key]
+            except KeyError:
+                return False, None, 0
+            remaining = expires - time.monotonic()
+            if remaining + self.stale <= 0:
+                return False, None, 0
+            return True, value, remaining
+
+    def put(self, key, value, ttl):
+        """
+        Store a value in the cache, evicting the least recently used entries if required.
+        :param key: Key to store the value under.
+        :param value: Value to store (None is a valid value and can be used for negative caching).
+        :param ttl: Time to live of the entry in seconds.
+        """
+        if ttl <= 0:
+            return
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, value, size)
+            self.size += size
+            while (self.max_entries is not None and len(self._entries) > self.max_entries) or \
+                    (self.max_bytes is not None and self.size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        """
+        Remove a key from the cache if it exists.
+        :param key: Key to remove.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        """
+        Remove a key from the cache, the lock must be held by the caller.
+        :param key: Key to remove.
+        """
+        _, _, size = self._entries.pop(key)
+        self.size -= size
+
+
+class AnswerCache(TTLCache):
+    """
+    Cache of packed DNS responses keyed by question and EDNS parameters.
+    Hits are served by copying the transaction ID, RD bit and question section
+    of the query into the stored bytes, skipping building and packing entirely.
+    """
+
+    def fetch(self, key, data, question_end):
+        """
+        Fetch a packed response for a query.
+        :param key: Answer key for the query.
+        :param data: binary data in the form of a DNS query.
+        :param question_end: Offset of the end of the (only) question in the query.
+        :return: Packed response or None if not cached.
+        """
+        found, packet = self.get(key)
+        if not found:
+            return None
+        return b"".join((data[:2], bytes([(packet[2] & 0xFE) | (data[2] & 0x01)]), packet[3:12],
+                         data[12:question_end], packet[question_end:]))
+
@@ -0,0 +1,13 @@
+"""
+Compile a JSON export of the records table into a memory-mapped record store.
+Usage: python compile_store.py <export.json> <records.db>
+"""
+import sys
+from store import MmapStore, load_json
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__.strip())
+    count = MmapStore.compile(load_json(sys.argv[1]), sys.argv[2])
+    print("Compiled " + str(count) + " live records into " + sys.argv[2])
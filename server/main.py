@@ -1,5 +1,38 @@
-import threading, socket, dnslib, struct
-from search import search
+import threading, selectors, socket, dnslib, queue, logging, os
+from time import perf_counter
+from search import search, snapshot, store, record_cache, backend_flights, warm_up, reset_connections
+from cache import AnswerCache
+from wire import decode_query, format_error, truncated, FormatError
+from aio import AsyncTransportHandler
+from querylog import QueryLog
+from ratelimit import RateLimiter
+import metrics
+
+logger = logging.getLogger("DNS")
+# Define the packed response cache, keyed by question and EDNS parameters.
+answer_cache = AnswerCache(max_entries=int(os.environ.get("DNS_ANSWER_CACHE_ENTRIES", 10000)) or None)
+# Publish cache and backend coalescing counters.
+metrics.registry.register("dns_cache_requests_total", "counter", "Cache lookups by cache and result.",
+                          lambda: {(("cache", "answer"), ("result", "hit")): answer_cache.hits,
+                                   (("cache", "answer"), ("result", "miss")): answer_cache.misses,
+                                   (("cache", "record"), ("result", "hit")): record_cache.hits,
+                                   (("cache", "record"), ("result", "miss")): record_cache.misses})
+metrics.registry.register("dns_backend_requests_total", "counter", "Backend lookups issued or coalesced.",
+                          lambda: {(("result", "issued"),): backend_flights.issued,
+                                   (("result", "coalesced"),): backend_flights.coalesced})
+# Define the query log, written from a background thread ("text", "binary" or "off").
+QUERY_LOG = os.environ.get("DNS_QUERY_LOG", "text")
+query_log = QueryLog(QUERY_LOG, path=os.environ.get("DNS_QUERY_LOG_PATH"),
+                     rate=float(os.environ.get("DNS_QUERY_LOG_RATE", 1)),
+                     max_queued=int(os.environ.get("DNS_QUERY_LOG_QUEUE", 10000))) if QUERY_LOG != "off" else None
+if query_log is not None:
+    metrics.registry.register("dns_query_log_entries_total", "counter", "Query log entries written or dropped.",
+                              lambda: {(("result", "written"),): query_log.written,
+                                       (("result", "dropped"),): query_log.dropped})
+# Largest UDP response sent whatever the client advertises, to avoid IP fragmentation.
+MAX_UDP_SIZE = int(os.environ.get("DNS_MAX_UDP_SIZE", 1232))
+# Leave out authority and additional records from positive answers.
+MINIMAL_RESPONSES = os.environ.get("DNS_MINIMAL_RESPONSES") == "1"
 
 
 class TransportHandler():
@@ -7,16 +40,28 @@ class TransportHandler():
     Class to handle UDP DNS requests.
     """
 
-    def __init__(self):
+    def __init__(self, reuse_port=False, address=("0.0.0.0", 53)):
         """
         Constructor for the UDP Handler class.
+        :param reuse_port: Set SO_REUSEPORT so several processes can share port 53.
+        :param address: Address to bind the UDP and TCP sockets to.
         """
         self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.udp_sock.bind(("0.0.0.0", 53))
-        self.tcp_sock.bind(("0.0.0.0", 53))
+        if reuse_port:
+            self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.udp_sock.bind(address)
+        self.tcp_sock.bind(address)
         self.tcp_sock.listen(5)
         self.clients_list = []
+        self.dropped = 0
+        # Optional RateLimiter for UDP queries.
+        self.limiter = None
+        # Optional semaphore bounding the threads of the thread per request core.
+        self.threads = None
+        # Optional ZoneTransfer answering AXFR and IXFR queries over TCP.
+        self.transfer = None
 
     def _edns_check(self, opt_record):
         """
@@ -30,13 +75,145 @@ class TransportHandler():
             return False, opt
         return True, dnslib.EDNS0(version=0, ext_rcode=0, flags=flags, udp_len=opt_record.edns_len)
 
-    def _build_response(self, data):
+    def _size_limit(self, udp_len, tcp):
+        """
+        Finds the largest response that can be sent to a client.
+        :param udp_len: UDP payload size advertised through EDNS, or None without EDNS.
+        :param tcp: Whether the query arrived over TCP.
+        :return: Maximum response size in bytes.
+        """
+        if tcp:
+            return 65535
+        if udp_len is None:
+            return 512
+        return min(max(udp_len, 512), MAX_UDP_SIZE)
+
+    def _answer_key(self, query, limit):
+        """
+        Builds the answer cache key for a decoded query.
+        :param query: Decoded DNS query.
+        :param limit: Maximum response size in bytes.
+        :return: Key covering everything the response depends on, or None if it should not be cached.
+        """
+        if query is None:
+            return None
+        if query.edns is None:
+            return query.qname.lower(), query.qtype, query.qclass, None, limit
+        version, do, udp_len = query.edns
+        if version != 0:
+            return None
+        return query.qname.lower(), query.qtype, query.qclass, (do, udp_len), limit
+
+    def _build_packet(self, data, tcp=False, client=None, cached_only=False):
         """
-        Builds the DNS response given binary data as a query.
+        Builds the packed DNS response given binary data as a query,
+        counting responses by query type and response code and adding them to the query log.
         :param data: binary data in the form of a DNS query.
+        :param tcp: Whether the query arrived over TCP, otherwise the response is fitted to the UDP size.
+        :param client: client address, for the query log.
+        :param cached_only: Only answer from the answer cache, without parsing or searching.
+        :return: DNS response encoded into binary form or None if no response should be sent
+        (or, with cached_only, if the answer is not cached).
+        """
+        packet, q_type = metrics.profiled(self._answer, data, tcp, cached_only)
+        if packet is None and cached_only:
+            return None
+        if packet is not None:
+            metrics.registry.increment("dns_responses_total",
+                                       (("qtype", dnslib.QTYPE.get(q_type, q_type)), ("rcode", packet[3] & 0x0F)))
+        if query_log is not None:
+            query_log.log(data, packet, client, tcp)
+        return packet
+
+    def _answer(self, data, tcp, cached_only=False):
+        """
+        Builds the packed DNS response given binary data as a query,
+        serving it from the answer cache where possible.
+        Plain queries are decoded without dnslib, anything else falls back to the full parser.
+        :param data: binary data in the form of a DNS query.
+        :param tcp: Whether the query arrived over TCP.
+        :param cached_only: Return no response rather than building one when the answer is not cached.
+        :return: Tuple of the packed response (None if no response should be sent) and the query type.
+        """
+        started = perf_counter()
+        try:
+            query = decode_query(data)
+        except FormatError:
+            return format_error(data), None
+        limit, key = None, None
+        if query is not None:
+            limit = self._size_limit(query.edns[2] if query.edns is not None else None, tcp)
+            key = self._answer_key(query, limit)
+        if key is not None:
+            packet = answer_cache.fetch(key, data, query.question_end)
+            if packet is not None:
+                metrics.stage("parse", started, perf_counter())
+                return packet, query.qtype
+        if cached_only:
+            return None, None
+        try:
+            request = dnslib.DNSRecord.parse(data)
+        except dnslib.DNSError:
+            return format_error(data), None
+        metrics.stage("parse", started, perf_counter())
+        if limit is None:
+            opt = request.ar[0] if request.ar != [] and request.ar[0].rtype == dnslib.QTYPE.OPT else None
+            limit = self._size_limit(opt.edns_len if opt is not None else None, tcp)
+        lifetimes = []
+        response = self._build_response(request, lifetimes)
+        started = perf_counter()
+        packet = self._pack(response, limit)
+        metrics.stage("pack", started, perf_counter())
+        if key is not None:
+            ttl = self._response_ttl(response)
+            if ttl is not None:
+                # Never outlive the cached records the response was built from, so changes show within a TTL.
+                answer_cache.put(key, packet, min([ttl] + lifetimes))
+        return packet, request.q.qtype if request.questions != [] else None
+
+    def _pack(self, response, limit):
+        """
+        Packs a response into at most limit bytes.
+        Additional then authority records are dropped if they do not fit,
+        if the answer still does not fit it is left out and the TC bit set.
+        :param response: DNS response, trimmed in place.
+        :param limit: Maximum response size in bytes.
+        :return: DNS response encoded into binary form.
+        """
+        packet = response.pack()
+        if len(packet) <= limit:
+            return packet
+        response.ar = [rr for rr in response.ar if rr.rtype == dnslib.QTYPE.OPT]
+        packet = response.pack()
+        if len(packet) <= limit:
+            return packet
+        response.auth = []
+        packet = response.pack()
+        if len(packet) <= limit:
+            return packet
+        response.rr = []
+        response.header.tc = 1
+        return response.pack()
+
+    def _response_ttl(self, response):
+        """
+        Finds how long a response can be cached for.
+        :param response: DNS response.
+        :return: Lowest TTL in the response (SOA minimum for negative answers) or None if it has no records.
+        """
+        ttls = [rr.ttl for rr in response.rr + response.auth + response.ar if rr.rtype != dnslib.QTYPE.OPT]
+        if response.rr == []:
+            ttls += [rr.rdata.times[4] for rr in response.auth if rr.rtype == dnslib.QTYPE.SOA]
+        return min(ttls) if ttls != [] else None
+
+    def _build_response(self, request, lifetimes=None):
+        """
+        Builds the DNS response given a parsed DNS query.
+        :param request: Parsed DNS query.
+        :param lifetimes: Optional list, extended with the seconds left in the record cache
+        for each record the response was built from.
         :return: DNS response ready to be encoded into binary form.
         """
-        request = dnslib.DNSRecord.parse(data)
         recursion_desired = request.header.rd
         id = request.header.id
         answer, authority, additional, aa, rcode, ok = [], [], [], 0, 0, True
@@ -44,12 +221,24 @@ class TransportHandler():
             ok, opt = self._edns_check(request.ar[0])
             additional.append(opt)
         if ok:
-            for question in request.questions:
-                domain = question.qname.idna()
-                rr_set, auth_set, addi_set = search(domain, question.qtype)
-                answer += rr_set
-                authority += auth_set
-                additional += addi_set
+            try:
+                domains = [question.qname.idna() for question in request.questions]
+            except UnicodeError:
+                # Names that are not valid IDNA, such as ones holding raw non-ASCII bytes, are malformed queries.
+                return self._error_response(request, 1, additional)
+            try:
+                for question, domain in zip(request.questions, domains):
+                    rr_set, auth_set, addi_set = search(domain, question.qtype, lifetimes)
+                    answer += rr_set
+                    authority += auth_set
+                    additional += addi_set
+            except Exception:
+                # The backend failed with no stale data to answer from.
+                logger.exception("Lookup failed")
+                return self._error_response(request, 2, additional)
+            if answer != [] and MINIMAL_RESPONSES:
+                authority = []
+                additional = [rr for rr in additional if rr.rtype == dnslib.QTYPE.OPT]
             if authority != [] or answer != []:
                 aa = 1  # Mark as authorative answer.
             elif answer == [] and authority == []:
@@ -61,67 +250,286 @@ class TransportHandler():
                                     auth=authority,
                                     ar=additional)
 
-    def _send_response(self, response, protocol, connection=None, ip=None):
+    def _error_response(self, request, rcode, additional):
         """
-        Send result to querying client through transport socket.
-        :param protocol: Transport protocol in use.
-        :param connection: TCP connection.
-        :param response: response to send.
+        Builds an empty error response to a parsed DNS query.
+        :param request: Parsed DNS query.
+        :param rcode: Response code, e.g. 1 (FORMERR) or 2 (SERVFAIL).
+        :param additional: Additional list built so far, only its OPT record is kept.
+        :return: DNS response ready to be encoded into binary form.
+        """
+        return dnslib.DNSRecord(dnslib.DNSHeader(id=request.header.id, qr=1, ra=0, rd=request.header.rd, rcode=rcode),
+                                questions=request.questions,
+                                ar=[rr for rr in additional if rr.rtype == dnslib.QTYPE.OPT])
+
+    def _send_response(self, response, ip):
+        """
+        Send result to querying client through the UDP socket.
+        :param response: packed response to send, nothing is sent if None.
         :param ip: IP address of client.
         """
-        # Write to the socket.
-        if protocol == "udp":
-            self.udp_sock.sendto(response.pack(), ip)
-        else:
-            # Pack the response with length for TCP transmission
-            response = response.pack()
-            length = struct.pack(">H", len(response))
-            connection.sendall(length + response)
-            connection.close()
+        if response is not None:
+            started = perf_counter()
+            try:
+                self.udp_sock.sendto(response, ip)
+            except BlockingIOError:
+                return # The batched listener's non-blocking socket buffer is full, drop the response.
+            metrics.stage("sendto", started, perf_counter())
 
-    def respond(self, data, protocol, connection=None, ip=None):
+    def respond(self, data, ip):
         """
         Response handler function.
         :param data: incoming binary data to parse.
-        :param protocol: request transport protocol.
-        :param connection: optional TCP connection.
-        :param ip: optional client IP address.
+        :param ip: client IP address.
         """
-        response = self._build_response(data)
-        self._send_response(response, protocol, connection, ip)
+        response = self._build_packet(data, client=ip)
+        self._send_response(response, ip)
 
-    def udp_listen(self):
+    def _respond_thread(self, data, ip):
+        """
+        Respond from a thread of the thread per request core, releasing its slot when done.
+        :param data: incoming binary data to parse.
+        :param ip: client IP address.
+        """
+        try:
+            self.respond(data, ip)
+        finally:
+            self.threads.release()
+
+    def _rate_limit(self, data, client):
+        """
+        Apply response rate limiting to a UDP query.
+        :param data: incoming binary data.
+        :param client: client address.
+        :return: Tuple of whether to answer the query and the truncated response to send instead (or None).
+        """
+        if self.limiter is None:
+            return True, None
+        action = self.limiter.check(client[0])
+        if action == "answer":
+            return True, None
+        return False, truncated(data) if action == "slip" else None
+
+    def _dispatch(self, requests, args):
+        """
+        Hand a DNS request to a worker.
+        :param requests: Bounded worker queue, or None to spawn a new thread for the request.
+        :param args: arguments for respond.
+        :return: Whether the request was accepted.
+        """
+        if requests is None:
+            if self.threads is None:
+                threading.Thread(target=self.respond, args=args).start()
+                return True
+            if not self.threads.acquire(blocking=False):
+                self.dropped += 1
+                return False
+            threading.Thread(target=self._respond_thread, args=args).start()
+            return True
+        try:
+            requests.put_nowait(args)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def worker(self, requests):
+        """
+        Serve DNS requests from a worker queue forever.
+        :param requests: Queue of respond arguments.
+        """
+        while True:
+            args = requests.get()
+            try:
+                self.respond(*args)
+            except Exception:
+                logger.exception("Request failed")
+
+    def udp_listen(self, requests=None):
         """
         Listen for incoming UDP datagrams.
-        Spawns new threads for each DNS request.
+        Spawns new threads for each DNS request unless a worker queue is given.
+        Rate limited queries are dropped or answered with a truncated response here.
+        :param requests: Optional bounded worker queue, requests are dropped when it is full.
         """
         while True:
             data, client = self.udp_sock.recvfrom(8192)
-            threading.Thread(target=self.respond, args=(data, "udp"),
-                             kwargs={
-                                 "ip" : client
-                             }).start()
+            answer, response = self._rate_limit(data, client)
+            if answer:
+                self._dispatch(requests, (data, client))
+            else:
+                self._send_response(response, client)
 
-    def tcp_listen(self):
+
+    def udp_listen_batch(self, requests=None, batch=64, mmsg=True):
         """
-        Listen for incoming TCP segments.
-        Spawns new threads for each DNS request.
+        Listen for incoming UDP datagrams on a non-blocking socket, reading every pending
+        datagram into preallocated buffers on each wakeup.
+        Queries with a cached answer are answered in this thread and their responses sent together,
+        the rest are handed to worker threads as in udp_listen.
+        :param requests: Optional bounded worker queue, requests are dropped when it is full.
+        :param batch: Maximum number of datagrams read or sent at once.
+        :param mmsg: Use recvmmsg and sendmmsg where available.
         """
+        from batchio import open_batch_socket
+        self.udp_sock.setblocking(False)
+        batch_sock = open_batch_socket(self.udp_sock, batch, mmsg)
+        selector = selectors.DefaultSelector()
+        selector.register(self.udp_sock, selectors.EVENT_READ)
         while True:
-            connection, _ = self.tcp_sock.accept()
-            data = connection.recv(8192).strip()
-            length = struct.unpack(">H", data[:2])[0] # Extract and check length (first 2 bytes)
-            if len(data[2:]) != length: # If length is incorrect then terminate
-                connection.close()
-                continue
-            threading.Thread(target=self.respond, args=(data[2:], "tcp"),
-                             kwargs={
-                                 "connection" : connection
-                             }).start()
+            selector.select()
+            while True:
+                datagrams = batch_sock.recv()
+                replies = []
+                for data, client in datagrams:
+                    answer, response = self._rate_limit(data, client)
+                    if answer:
+                        response = self._build_packet(data, client=client, cached_only=True)
+                        if response is None:
+                            # The buffer is reused, so the worker gets its own copy.
+                            self._dispatch(requests, (bytes(data), client))
+                    if response is not None:
+                        replies.append((response, client))
+                if replies != []:
+                    started = perf_counter()
+                    batch_sock.send(replies)
+                    metrics.stage("sendto", started, perf_counter())
+                if len(datagrams) < batch:
+                    break
+
+
+def serve(handler):
+    """
+    Serve DNS requests on the handler sockets with the configured serving core forever.
+    :param handler: TransportHandler to serve requests with.
+    """
+    # Select the serving core: "thread" (thread per request), "pool" or "asyncio".
+    # TCP is always served from an event loop as per RFC 7766.
+    core = os.environ.get("DNS_SERVER_CORE", "thread")
+    workers = int(os.environ.get("DNS_WORKERS", 32))
+    max_inflight = int(os.environ.get("DNS_MAX_INFLIGHT", 1024))
+    server = AsyncTransportHandler(handler, workers=workers, max_inflight=max_inflight,
+                                   max_connections=int(os.environ.get("DNS_TCP_MAX_CONNECTIONS", 256)),
+                                   max_pipeline=int(os.environ.get("DNS_TCP_PIPELINE", 16)),
+                                   idle_timeout=float(os.environ.get("DNS_TCP_IDLE_TIMEOUT", 10)))
+    # Optionally enlarge the UDP socket buffers to absorb bursts.
+    for option, name in ((socket.SO_RCVBUF, "DNS_UDP_RCVBUF"), (socket.SO_SNDBUF, "DNS_UDP_SNDBUF")):
+        size = int(os.environ.get(name, 0))
+        if size:
+            handler.udp_sock.setsockopt(socket.SOL_SOCKET, option, size)
+    # Bound the threads of the thread per request core like the other cores.
+    if core == "thread":
+        handler.threads = threading.BoundedSemaphore(max_inflight)
+    # Optionally rate limit UDP queries per source prefix.
+    rate = float(os.environ.get("DNS_RRL_RATE", 0))
+    if rate:
+        limiter = handler.limiter = RateLimiter(rate, burst=float(os.environ.get("DNS_RRL_BURST", 0)) or None,
+                                                slip=int(os.environ.get("DNS_RRL_SLIP", 2)),
+                                                size=int(os.environ.get("DNS_RRL_TABLE", 65536)),
+                                                ipv4_prefix=int(os.environ.get("DNS_RRL_IPV4_PREFIX", 24)),
+                                                ipv6_prefix=int(os.environ.get("DNS_RRL_IPV6_PREFIX", 56)))
+        metrics.registry.register("dns_rate_limited_total", "counter", "Rate limited queries by action.",
+                                  lambda: {(("action", "drop"),): limiter.dropped,
+                                           (("action", "slip"),): limiter.slipped})
+    metrics.registry.register("dns_dropped_total", "counter", "Queries dropped by admission limits.",
+                              lambda: {(): handler.dropped + server.dropped})
+    metrics.registry.register("dns_inflight", "gauge", "Threads and event loop requests currently running.",
+                              lambda: {(("kind", "threads"),): threading.active_count(),
+                                       (("kind", "async"),): server.inflight + server.connections})
+    if core == "asyncio":
+        server.run()
+    else:
+        requests = queue.Queue(maxsize=max_inflight) if core == "pool" else None
+        if requests is not None:
+            for _ in range(workers):
+                threading.Thread(target=handler.worker, args=(requests,), daemon=True).start()
+        batch = int(os.environ.get("DNS_UDP_BATCH", 0))
+        if batch:
+            threading.Thread(target=handler.udp_listen_batch, daemon=True,
+                             args=(requests, batch, os.environ.get("DNS_UDP_MMSG", "1") == "1")).start()
+        else:
+            threading.Thread(target=handler.udp_listen, args=(requests,), daemon=True).start()
+        server.run(udp=False)
+
+def open_transfer():
+    """
+    Set up zone transfers if enabled, before any worker process is forked.
+    :return: ZoneTransfer or None if transfers are disabled.
+    """
+    transfer_allow = os.environ.get("DNS_XFR_ALLOW")
+    if not transfer_allow:
+        return None
+    from xfr import ZoneTransfer
+    notify = [(host, int(port)) for host, port in
+              (target.strip().rsplit(":", 1) for target in os.environ.get("DNS_XFR_NOTIFY", "").split(",")
+               if target.strip())]
+    return ZoneTransfer(snapshot if snapshot is not None else store,
+                        allow=transfer_allow.split(","), notify=notify,
+                        message_size=int(os.environ.get("DNS_XFR_MESSAGE_SIZE", 16384)),
+                        notify_interval=int(os.environ.get("DNS_XFR_NOTIFY_INTERVAL", 60)))
+
+def run_worker(reuse_port=False, slot=0, transfer=None):
+    """
+    Bind the DNS sockets and serve requests in this process.
+    :param reuse_port: Share port 53 with other worker processes.
+    :param slot: Worker number, each worker serves metrics on its own port.
+    :param transfer: Optional ZoneTransfer answering AXFR and IXFR queries, worker 0 sends its NOTIFY messages.
+    """
+    if reuse_port:
+        # Forked after the snapshot load and warm-up, which may have connected to the backends.
+        reset_connections()
+    metrics_port = int(os.environ.get("DNS_METRICS_PORT", 0))
+    if metrics_port:
+        metrics.serve(metrics_port + slot, os.environ.get("DNS_METRICS_ADDRESS", "127.0.0.1"))
+    metrics.profile_rate = float(os.environ.get("DNS_PROFILE_RATE", 0))
+    if query_log is not None:
+        query_log.start("." + str(slot) if reuse_port else "")
+    if snapshot is not None:
+        if reuse_port and slot != 0:
+            snapshot.follow(snapshot.path) # Worker 0 alone refreshes from the store.
+        snapshot.listeners.append(answer_cache.clear)
+        snapshot.start()
+    address = (os.environ.get("DNS_ADDRESS", "0.0.0.0"), int(os.environ.get("DNS_PORT", 53)))
+    handler = TransportHandler(reuse_port=reuse_port, address=address)
+    if transfer is not None:
+        handler.transfer = transfer
+        metrics.registry.register("dns_zone_transfers_total", "counter", "Zone transfers by result.",
+                                  lambda: {(("result", "served"),): transfer.transfers,
+                                           (("result", "refused"),): transfer.refused,
+                                           (("result", "notified"),): transfer.notified})
+        if slot == 0:
+            if snapshot is not None:
+                snapshot.listeners.append(transfer.changed)
+            transfer.start()
+    serve(handler)
 
 
 if __name__ == '__main__':
-    # Make sure all log messages show up
-    handler = TransportHandler()
-    threading.Thread(target=handler.udp_listen).start()
-    threading.Thread(target=handler.tcp_listen).start()
\ No newline at end of file
+    # Load the snapshot once so forked workers share it.
+    if snapshot is not None:
+        snapshot.load()
+    # Fill the caches with hot names before any socket is bound, forked workers share them too.
+    warm_up_file = os.environ.get("DNS_WARMUP_FILE")
+    if warm_up_file:
+        started = perf_counter()
+        count = warm_up(warm_up_file, workers=int(os.environ.get("DNS_WARMUP_WORKERS", 16)))
+        logger.info("Warmed up " + str(count) + " names in %.2fs", perf_counter() - started)
+    processes = int(os.environ.get("DNS_PROCESSES", 1))
+    transfer = open_transfer()
+    if processes > 1:
+        from supervisor import Supervisor
+        if transfer is not None:
+            transfer.share()
+        if snapshot is not None:
+            # Worker 0 publishes every refresh for the other workers to load.
+            import tempfile
+            snapshot.publish(os.environ.get("DNS_SNAPSHOT_PATH") or
+                             os.path.join(tempfile.gettempdir(), "dns-snapshot-" + str(os.getpid()) + ".db"))
+        try:
+            Supervisor(lambda slot: run_worker(reuse_port=True, slot=slot, transfer=transfer), processes,
+                       pin_cpus=os.environ.get("DNS_PIN_CPUS") == "1").run()
+        finally:
+            if snapshot is not None and not os.environ.get("DNS_SNAPSHOT_PATH"):
+                os.remove(snapshot.path)
+    else:
+        run_worker(transfer=transfer)
@@ -0,0 +1,265 @@
+import math, threading, random, io, logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+logger = logging.getLogger("DNS")
+
+
+class Histogram():
+    """
+    Log-linear (HDR style) histogram of durations in seconds.
+    Every power of two is split into a fixed number of linear sub-buckets, so recording
+    a value is a constant time index computation whatever its magnitude.
+    """
+
+    MIN_EXPONENT = -20 # 2^-21 s, just under 0.5 us.
+    MAX_EXPONENT = 4 # 2^4 s, anything slower lands in the last bucket.
+    SUB_BUCKETS = 4
+
+    def __init__(self):
+        """
+        Constructor for the histogram class.
+        """
+        self.counts = [0] * ((self.MAX_EXPONENT - self.MIN_EXPONENT) * self.SUB_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Record a duration.
+        :param value: Duration in seconds.
+        """
+        mantissa, exponent = math.frexp(value)
+        if value <= 0 or exponent < self.MIN_EXPONENT:
+            index = 0
+        elif exponent >= self.MAX_EXPONENT:
+            index = len(self.counts) - 1
+        else:
+            index = (exponent - self.MIN_EXPONENT) * self.SUB_BUCKETS + \
+                int((mantissa - 0.5) * 2 * self.SUB_BUCKETS)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def bound(self, index):
+        """
+        Upper bound of a bucket.
+        :param index: Bucket index.
+        :return: Upper bound in seconds.
+        """
+        exponent, sub = divmod(index, self.SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub + 1) / (2 * self.SUB_BUCKETS), exponent + self.MIN_EXPONENT)
+
+    def percentile(self, fraction):
+        """
+        Estimate a percentile from the buckets.
+        :param fraction: Percentile as a fraction, e.g. 0.99.
+        :return: Upper bound of the bucket holding the percentile, in seconds.
+        """
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return self.bound(index)
+        return 0.0
+
+
+class Registry():
+    """
+    Class to hold every metric and render them in the Prometheus text format.
+    """
+
+    def __init__(self):
+        """
+        Constructor for the registry class.
+        """
+        self.histograms = {}
+        self.counters = {}
+        self.callbacks = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        """
+        Record a value in a labelled histogram.
+        :param name: Metric name.
+        :param labels: Tuple of (label, value) pairs.
+        :param value: Value to record.
+        """
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault((name, labels), Histogram())
+        histogram.observe(value)
+
+    def increment(self, name, labels, amount=1):
+        """
+        Increase a labelled counter.
+        :param name: Metric name.
+        :param labels: Tuple of (label, value) pairs.
+        :param amount: Amount to add.
+        """
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def register(self, name, kind, help, function):
+        """
+        Register a metric read from a function whenever metrics are rendered.
+        :param name: Metric name.
+        :param kind: Prometheus type, "counter" or "gauge".
+        :param help: Help text.
+        :param function: Function returning a dictionary of label tuples to values.
+        """
+        self.callbacks[name] = (kind, function)
+        self.help[name] = help
+
+    def describe(self, name, help):
+        """
+        Set the help text of a histogram or counter.
+        :param name: Metric name.
+        :param help: Help text.
+        """
+        self.help[name] = help
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+        :return: Metrics text.
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        written = set()
+        for (name, labels), histogram in histograms:
+            self._header(lines, written, name, "histogram")
+            # Every bucket is written, even when empty, so the set of series never changes between scrapes.
+            # The last bucket also holds values over its bound, so it is only counted in +Inf.
+            cumulative = 0
+            for index, count in enumerate(histogram.counts[:-1]):
+                cumulative += count
+                lines.append(name + "_bucket" + _labels(labels + (("le", repr(histogram.bound(index))),)) +
+                             " " + str(cumulative))
+            lines.append(name + "_bucket" + _labels(labels + (("le", "+Inf"),)) + " " + str(histogram.count))
+            lines.append(name + "_sum" + _labels(labels) + " " + repr(histogram.sum))
+            lines.append(name + "_count" + _labels(labels) + " " + str(histogram.count))
+        for (name, labels), value in counters:
+            self._header(lines, written, name, "counter")
+            lines.append(name + _labels(labels) + " " + str(value))
+        for name, (kind, function) in sorted(self.callbacks.items()):
+            self._header(lines, written, name, kind)
+            for labels, value in sorted(function().items()):
+                lines.append(name + _labels(labels) + " " + str(value))
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines, written, name, kind):
+        """
+        Add the HELP and TYPE lines for a metric the first time it is written.
+        """
+        if name not in written:
+            written.add(name)
+            if name in self.help:
+                lines.append("# HELP " + name + " " + self.help[name])
+            lines.append("# TYPE " + name + " " + kind)
+
+
+def _labels(labels):
+    """
+    Format a label tuple for the Prometheus text format.
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join(key + '="' + str(value) + '"' for key, value in labels) + "}"
+
+
+# Define the process wide registry.
+registry = Registry()
+registry.describe("dns_stage_seconds", "Time spent in each stage of answering a query.")
+registry.describe("dns_responses_total", "Responses sent by query type and response code.")
+
+
+def stage(name, started, finished):
+    """
+    Record the duration of a request stage.
+    :param name: Stage name.
+    :param started: perf_counter value at the start of the stage.
+    :param finished: perf_counter value at the end of the stage.
+    """
+    registry.observe("dns_stage_seconds", (("stage", name),), finished - started)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler serving the registry on /metrics.
+    """
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, address="127.0.0.1"):
+    """
+    Serve metrics over HTTP in a background thread.
+    :param port: Port to listen on.
+    :param address: Address to listen on.
+    :return: The HTTP server.
+    """
+    server = _ThreadingHTTPServer((address, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _log_profile(profile):
+    """
+    Default profiling hook logging the most expensive calls of a sampled query.
+    :param profile: cProfile.Profile of the query.
+    """
+    import pstats
+    output = io.StringIO()
+    pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(15)
+    logger.info("Sampled query profile:\n" + output.getvalue())
+
+
+# Fraction of queries to profile and the function receiving each sampled profile.
+profile_rate = 0.0
+profile_hook = _log_profile
+# Only one query is profiled at a time.
+_profiling = threading.Lock()
+
+
+def profiled(function, *args):
+    """
+    Call a function, profiling a sampled fraction of calls and passing the profile to profile_hook.
+    :param function: Function to call.
+    :param args: Arguments for the function.
+    :return: Result of the function.
+    """
+    if profile_rate <= 0 or random.random() >= profile_rate or not _profiling.acquire(blocking=False):
+        return function(*args)
+    try:
+        import cProfile
+        profile = cProfile.Profile()
+        result = profile.runcall(function, *args)
+        profile_hook(profile)
+        return result
+    finally:
+        _profiling.release()
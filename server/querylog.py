@@ -0,0 +1,170 @@
+"""
+Query log written from a background thread, as text or as length prefixed binary frames.
+Usage: python querylog.py <binary log> prints a binary log as text.
+"""
+import sys, time, queue, random, socket, struct, logging, threading, dnslib
+
+logger = logging.getLogger("DNS")
+
+
+class QueryLog():
+    """
+    Class to log queries and their responses without slowing down requests.
+    Requests only hand the raw query and response over through a bounded queue, entries are dropped
+    rather than blocking when the writer falls behind, and all formatting happens on the writer thread.
+    Binary frames are: frame length, timestamp, flags (bit 0 set for TCP), client address length,
+    client address, client port, query length, query, then the response filling the rest of the frame.
+    """
+
+    _LENGTH = struct.Struct(">I")
+    _HEADER = struct.Struct(">dBB")
+    _SHORT = struct.Struct(">H")
+
+    def __init__(self, format="text", path=None, rate=1.0, max_queued=10000, batch=256):
+        """
+        Constructor for the query log class.
+        :param format: "text" or "binary".
+        :param path: File to append to, text entries go to the DNS logger when None.
+        :param rate: Fraction of queries to log.
+        :param max_queued: Maximum number of entries waiting for the writer.
+        :param batch: Maximum number of entries written at once.
+        """
+        if format not in ("text", "binary"):
+            raise ValueError("Unknown query log format " + format)
+        if format == "binary" and path is None:
+            raise ValueError("A binary query log needs a path")
+        self.format = format
+        self.path = path
+        self.rate = rate
+        self.batch = batch
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._file = None
+
+    def log(self, query, response, client=None, tcp=False):
+        """
+        Queue a query and its response for logging, unless it is not sampled or the queue is full.
+        :param query: Query as received.
+        :param response: Packed response or None if none was sent.
+        :param client: Client (address, port) tuple.
+        :param tcp: Whether the query arrived over TCP.
+        """
+        if self.rate < 1 and random.random() >= self.rate:
+            return
+        try:
+            self._queue.put_nowait((time.time(), client, tcp, bytes(query), response or b""))
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self, suffix=""):
+        """
+        Open the log file and start the writer thread.
+        :param suffix: Appended to the path, so every worker process writes its own file.
+        """
+        if self.path is not None:
+            self._file = open(self.path + suffix, "ab" if self.format == "binary" else "a")
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _write_loop(self):
+        """
+        Write queued entries forever, taking as many as are waiting at once.
+        """
+        while True:
+            entries = [self._queue.get()]
+            try:
+                while len(entries) < self.batch:
+                    entries.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self._write(entries)
+            except Exception:
+                logger.exception("Failed to write the query log")
+            self.written += len(entries)
+
+    def _write(self, entries):
+        """
+        Write a batch of entries in the configured format.
+        :param entries: List of queued entries.
+        """
+        if self.format == "binary":
+            self._file.write(b"".join(self.frame(*entry) for entry in entries))
+            self._file.flush()
+        elif self._file is None:
+            for entry in entries:
+                logger.info(format_entry(*entry))
+        else:
+            self._file.write("".join(format_entry(*entry) + "\n" for entry in entries))
+            self._file.flush()
+
+    @classmethod
+    def frame(cls, timestamp, client, tcp, query, response):
+        """
+        Encode an entry as a length prefixed binary frame.
+        :return: Frame bytes.
+        """
+        address, port = client[:2] if client is not None else ("", 0)
+        packed = b""
+        if address:
+            packed = socket.inet_pton(socket.AF_INET6 if ":" in address else socket.AF_INET, address)
+        body = cls._HEADER.pack(timestamp, 1 if tcp else 0, len(packed)) + packed + \
+            cls._SHORT.pack(port) + cls._SHORT.pack(len(query)) + query + response
+        return cls._LENGTH.pack(len(body)) + body
+
+    @classmethod
+    def read(cls, file):
+        """
+        Read the entries of a binary log.
+        :param file: Binary file object.
+        :return: Generator of (timestamp, client, tcp, query, response) tuples.
+        """
+        while True:
+            prefix = file.read(cls._LENGTH.size)
+            if len(prefix) < cls._LENGTH.size:
+                return
+            body = file.read(cls._LENGTH.unpack(prefix)[0])
+            timestamp, flags, address_length = cls._HEADER.unpack_from(body)
+            offset = cls._HEADER.size
+            packed = body[offset:offset + address_length]
+            offset += address_length
+            port = cls._SHORT.unpack_from(body, offset)[0]
+            query_length = cls._SHORT.unpack_from(body, offset + 2)[0]
+            offset += 4
+            client = None
+            if packed:
+                client = (socket.inet_ntop(socket.AF_INET6 if len(packed) == 16 else socket.AF_INET, packed), port)
+            yield (timestamp, client, bool(flags & 1), body[offset:offset + query_length],
+                   body[offset + query_length:])
+
+
+def format_entry(timestamp, client, tcp, query, response):
+    """
+    Format a log entry as a line of text.
+    :return: Text line.
+    """
+    line = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + ".%06dZ " % (timestamp % 1 * 1e6)
+    if client is not None:
+        line += client[0] + "#" + str(client[1]) + " "
+    line += "TCP " if tcp else "UDP "
+    try:
+        request = dnslib.DNSRecord.parse(query)
+        line += str(request.q.qname) + " " + dnslib.QTYPE.get(request.q.qtype, str(request.q.qtype))
+    except Exception:
+        return line + "malformed query " + query.hex()
+    if not response:
+        return line + " no response"
+    try:
+        reply = dnslib.DNSRecord.parse(response)
+    except Exception:
+        return line + " unparsable response " + response.hex()
+    return line + " " + dnslib.RCODE.get(reply.header.rcode, str(reply.header.rcode)) + \
+        " RR: " + str(reply.rr) + " Auth: " + str(reply.auth) + " Add: " + str(reply.ar)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit(__doc__.strip())
+    with open(sys.argv[1], "rb") as file:
+        for entry in QueryLog.read(file):
+            print(format_entry(*entry))
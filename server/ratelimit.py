@@ -0,0 +1,67 @@
+import time, socket, random
+from array import array
+
+
+class RateLimiter():
+    """
+    Response rate limiting (RRL) with a token bucket per source network prefix.
+    Buckets live in fixed size arrays indexed by a salted hash of the prefix, so memory use is
+    constant whatever the number of sources and prefixes colliding in the table share a bucket.
+    Not thread safe, queries must be checked from a single listener thread.
+    """
+
+    def __init__(self, rate, burst=None, slip=2, size=65536, ipv4_prefix=24, ipv6_prefix=56):
+        """
+        Constructor for the rate limiter class.
+        :param rate: Queries per second answered for each prefix.
+        :param burst: Queries answered at once after a quiet period (defaults to rate).
+        :param slip: Every slip-th limited query gets a truncated response so real clients retry over TCP (0 never).
+        :param size: Number of buckets.
+        :param ipv4_prefix: Length of the IPv4 prefix sharing a bucket.
+        :param ipv6_prefix: Length of the IPv6 prefix sharing a bucket.
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.slip = slip
+        self.size = size
+        self.ipv4_shift = 32 - ipv4_prefix
+        self.ipv6_shift = 128 - ipv6_prefix
+        self.dropped = 0
+        self.slipped = 0
+        self._tokens = array("d", [self.burst]) * size
+        self._updated = array("d", [0.0]) * size
+        self._salt = random.getrandbits(64)
+        self._limited = 0
+
+    def _bucket(self, address):
+        """
+        Find the bucket of a source address.
+        :param address: IPv4 or IPv6 address string.
+        :return: Bucket index.
+        """
+        if ":" in address:
+            prefix = int.from_bytes(socket.inet_pton(socket.AF_INET6, address), "big") >> self.ipv6_shift
+        else:
+            prefix = int.from_bytes(socket.inet_aton(address), "big") >> self.ipv4_shift
+        return hash((self._salt, prefix)) % self.size
+
+    def check(self, address):
+        """
+        Take a token for a query from a source address.
+        :param address: IPv4 or IPv6 address string.
+        :return: "answer", "slip" to send a truncated response or "drop".
+        """
+        index = self._bucket(address)
+        now = time.monotonic()
+        tokens = min(self.burst, self._tokens[index] + (now - self._updated[index]) * self.rate)
+        self._updated[index] = now
+        if tokens >= 1:
+            self._tokens[index] = tokens - 1
+            return "answer"
+        self._tokens[index] = tokens
+        self._limited += 1
+        if self.slip and self._limited % self.slip == 0:
+            self.slipped += 1
+            return "slip"
+        self.dropped += 1
+        return "drop"
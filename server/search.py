@@ -1,54 +1,331 @@
-import boto3, os, logging, dnslib, tldextract, socket
-from boto3.dynamodb.conditions import Key, Attr
+import os, logging, threading, dnslib, metrics
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from cache import TTLCache
+from snapshot import ZoneSnapshot
+from alias import AliasResolver
+from singleflight import SingleFlight
+from store import DynamoDBStore, open_store
+from suffix import PublicSuffixList
 
 # Set global logging level.
 logging.basicConfig(level=logging.INFO)
 # create logger with 'DNS'.
 logger = logging.getLogger("DNS")
 logger.setLevel(logging.INFO)
-# Define DynamoDB interaction system.
-dynamodb = boto3.resource('dynamodb',
-                          aws_access_key_id=os.environ["AWS_ACCESS_ID"],
-                          aws_secret_access_key=os.environ["AWS_ACCESS_KEY"],
-                          region_name='eu-west-2')
-# Define the records table.
-records = dynamodb.Table('records')
+# Define the record store, the DynamoDB records table unless a local store is configured.
+if os.environ.get("DNS_STORE", "dynamodb") == "dynamodb":
+    store = DynamoDBStore(segments=int(os.environ.get("DNS_SNAPSHOT_SEGMENTS", 4)),
+                          delta_attr=os.environ.get("DNS_SNAPSHOT_DELTA_ATTR"))
+else:
+    store = open_store(os.environ["DNS_STORE"], os.environ.get("DNS_STORE_PATH"))
+# Seconds past their TTL that records are kept to answer from when the backend fails or is slow (RFC 8767).
+STALE_TTL = int(os.environ.get("DNS_STALE_TTL", 0))
+# Seconds to wait for the backend to refresh an expired record before answering from the stale one.
+STALE_DEADLINE = float(os.environ.get("DNS_STALE_DEADLINE", 1))
+# Highest TTL of records in stale answers.
+STALE_ANSWER_TTL = 30
+# Refresh cached records in the background when a hit is this many seconds from expiring (0 disables).
+REFRESH_AHEAD = int(os.environ.get("DNS_REFRESH_AHEAD", 0))
+# Define the in-process record cache, keyed by lowercase domain (None marks a cached miss).
+record_cache = TTLCache(max_entries=int(os.environ.get("DNS_CACHE_ENTRIES", 10000)) or None,
+                        max_bytes=int(os.environ.get("DNS_CACHE_BYTES", 0)) or None,
+                        stale=STALE_TTL)
+# Define the background record refreshes, at most one in flight per domain.
+refresher = ThreadPoolExecutor(max_workers=int(os.environ.get("DNS_REFRESH_WORKERS", 4)))
+refreshing = {}
+refresh_lock = threading.Lock()
+metrics.registry.describe("dns_stale_answers_total", "Records answered from stale data by reason.")
+metrics.registry.describe("dns_refreshes_total", "Background record refreshes started.")
+# Optionally serve every lookup from an in-memory snapshot of the record store.
+snapshot = ZoneSnapshot(store, interval=int(os.environ.get("DNS_SNAPSHOT_INTERVAL", 30))) \
+    if os.environ.get("DNS_SNAPSHOT") == "1" else None
+# Define the resolver for ALIAS targets.
+upstream = os.environ.get("DNS_ALIAS_UPSTREAM", "10.0.0.2:53").rsplit(":", 1)
+alias_resolver = AliasResolver(upstream=(upstream[0], int(upstream[1])),
+                               timeout=float(os.environ.get("DNS_ALIAS_TIMEOUT", 1)),
+                               prefetch=int(os.environ.get("DNS_ALIAS_PREFETCH", 0)))
+# Coalesce concurrent backend lookups for the same domain and lookup kind,
+# issued and coalesced counts are kept on the object.
+backend_flights = SingleFlight()
+# Seconds to wait for a coalesced backend lookup made by another request.
+BACKEND_WAIT = float(os.environ.get("DNS_BACKEND_WAIT", 2))
+# Time to cache a miss for when no SOA record is available.
+NEGATIVE_TTL = int(os.environ.get("DNS_NEGATIVE_TTL", 60))
+# Public suffixes bounding the walk up to domain.tld, read from a local list and never downloaded.
+suffixes = PublicSuffixList.load(os.environ.get("DNS_SUFFIX_LIST"))
 
 
-def search(domain, q_type):
+class _CachedMiss(KeyError):
+    """
+    Raised when a domain is known not to exist from the negative cache.
+    """
+
+
+def search(domain, q_type, lifetimes=None):
     """
     Given an IDNA domain string and a record type,
     it will find the corresponding value if it exists.
     :param domain: IDNA domain string.
     :param record_type: Record type (A, AAAA, etc...)
+    :param lifetimes: Optional list, extended with the seconds left before each record cache entry
+    the answer was built from expires, so anything built from it can be dropped with them.
     :return: String representing record value or None.
     """
-    logger.info("Request: " + domain + " " + dnslib.QTYPE[q_type])
+    logger.debug("Request: %s %s", domain, q_type)
     rr_list, auth_list, addi_list = [], [], []
     try:
-        # Search the database for all live records on the domain
-        record = records.query(
-            KeyConditionExpression=Key('domain').eq(domain.lower()),
-            FilterExpression=Attr('live').eq(True)
-        )["Items"][0]
-        rr_list, auth_list, addi_list = _identify_record(record, q_type)
-    except (KeyError, IndexError):
-        if tldextract.extract(domain).subdomain != "": # Perform search up to domain.tld.
+        record = _get_record(domain)
+        started = perf_counter()
+        rr_list, auth_list, addi_list = _identify_record(record, q_type, lifetimes)
+        metrics.stage("identify", started, perf_counter())
+    except (KeyError, IndexError) as miss:
+        if suffixes.subdomain(domain) != "": # Perform search up to domain.tld.
+            _prefetch_ancestors(domain)
             parent_domain = domain.split(".", 1)[1:][0]
-            p_rr_list, p_auth_list, _ = search(domain=parent_domain, q_type=dnslib.QTYPE.SOA)
+            p_rr_list, p_auth_list, _ = search(domain=parent_domain, q_type=dnslib.QTYPE.SOA,
+                                               lifetimes=lifetimes)
             if p_rr_list == []:
                 auth_list.extend(p_auth_list)
             else:
                 auth_list.extend(p_rr_list)
-    logger.info("Response: " + domain + " RR: " + str(rr_list) + " Auth: " + str(auth_list) + " Add: " + str(addi_list))
+        if not isinstance(miss, _CachedMiss):
+            _cache_miss(domain, auth_list)
+    if lifetimes is not None and snapshot is None:
+        found, _, remaining = record_cache.peek(domain.lower())
+        if found:
+            lifetimes.append(remaining) # Negative for stale records, which are not worth keeping.
+    logger.debug("Response: %s RR: %s Auth: %s Add: %s", domain, rr_list, auth_list, addi_list)
     return rr_list, auth_list, addi_list
 
-def _identify_record(record, q_type):
+def warm_up(path, workers=16):
+    """
+    Look up a list of hot names ahead of the first query, filling the record and ALIAS caches.
+    Each line of the file holds a domain and optionally a record type (A when omitted),
+    blank lines and lines starting with # are skipped.
+    :param path: Warm-up file.
+    :param workers: Number of lookups made at once.
+    :return: Number of names looked up without error.
+    """
+    questions = []
+    with open(path) as file:
+        for line in file:
+            fields = line.split()
+            if fields == [] or fields[0].startswith("#"):
+                continue
+            domain = fields[0] if fields[0].endswith(".") else fields[0] + "."
+            try:
+                q_type = getattr(dnslib.QTYPE, fields[1].upper()) if len(fields) > 1 else dnslib.QTYPE.A
+                questions.append((domain.encode("idna").decode("ascii"), q_type))
+            except (AttributeError, UnicodeError, dnslib.DNSError):
+                logger.warning("Skipped invalid warm-up file line: " + line.strip())
+
+    def lookup(question):
+        try:
+            search(*question)
+            return True
+        except Exception:
+            logger.warning("Warm-up lookup of %s failed", question[0])
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(lookup, questions))
+
+def reset_connections():
+    """
+    Drop the backend connection and ALIAS upstream sockets, called in forked worker processes
+    so none are shared with the parent or other workers.
+    """
+    store.reset()
+    alias_resolver.close()
+
+def _get_record(domain):
+    """
+    Fetch the live DB record for a domain, using the record cache where possible.
+    :param domain: IDNA domain string.
+    :return: DB record for the domain.
+    :raises KeyError: If no live record exists for the domain.
+    """
+    key = domain.lower()
+    if snapshot is not None:
+        record = snapshot.get(key)
+        if record is None:
+            raise _CachedMiss(key)
+        return record
+    found, record = record_cache.get(key)
+    if found:
+        if REFRESH_AHEAD:
+            _refresh_ahead(key)
+        if record is None:
+            raise _CachedMiss(key)
+        return record
+    if STALE_TTL:
+        found, record, _ = record_cache.peek(key)
+        if found:
+            return _revalidate(key, record)
+    record = backend_flights.do((key, "record"), lambda: _query_record(key), timeout=BACKEND_WAIT)
+    if record is None:
+        raise KeyError(key)
+    return record
+
+def _refresh(key):
+    """
+    Refresh a cached record in the background, at most once at a time per domain.
+    :param key: Lowercase IDNA domain string.
+    :return: Future of the refreshed record.
+    """
+    with refresh_lock:
+        future = refreshing.get(key)
+        started = future is None
+        if started:
+            future = refreshing[key] = refresher.submit(
+                backend_flights.do, (key, "record"), lambda: _query_record(key), BACKEND_WAIT)
+    if started:
+        metrics.registry.increment("dns_refreshes_total", ())
+        future.add_done_callback(lambda done: _refresh_done(key, done))
+    return future
+
+def _refresh_done(key, future):
+    """
+    Forget a finished background refresh.
+    :param key: Lowercase IDNA domain string.
+    :param future: Future of the refresh.
+    """
+    with refresh_lock:
+        refreshing.pop(key, None)
+    if future.exception() is not None:
+        logger.warning("Failed to refresh " + key + ": " + repr(future.exception()))
+
+def _refresh_ahead(key):
+    """
+    Start refreshing a record that was just hit if it is about to expire,
+    so records in use are replaced before they run out.
+    :param key: Lowercase IDNA domain string.
+    """
+    found, _, remaining = record_cache.peek(key)
+    if found and 0 < remaining < REFRESH_AHEAD:
+        _refresh(key)
+
+def _revalidate(key, stale_record):
+    """
+    Refresh an expired record, answering from the stale record if the backend
+    fails or does not answer within the stale deadline.
+    :param key: Lowercase IDNA domain string.
+    :param stale_record: Expired DB record, None for an expired miss.
+    :return: DB record for the domain.
+    :raises KeyError: If no live record exists for the domain.
+    """
+    try:
+        record = _refresh(key).result(timeout=STALE_DEADLINE)
+    except Exception as error:
+        reason = "deadline" if isinstance(error, FutureTimeout) else "error"
+        logger.warning("Answering " + key + " from stale data, backend " + reason)
+        metrics.registry.increment("dns_stale_answers_total", (("reason", reason),))
+        if stale_record is None:
+            raise _CachedMiss(key)
+        return _stale_record(stale_record)
+    if record is None:
+        raise KeyError(key)
+    return record
+
+def _stale_record(record):
+    """
+    Copy a DB record with every TTL capped for answering from stale data.
+    :param record: Expired DB record.
+    :return: DB record.
+    """
+    stale = dict(record)
+    for name, value in record.items():
+        if isinstance(value, dict) and "ttl" in value:
+            stale[name] = dict(value, ttl=min(int(value["ttl"]), STALE_ANSWER_TTL))
+    return stale
+
+def _query_record(domain):
+    """
+    Query the record store for the live record of a domain and cache it.
+    :param domain: Lowercase IDNA domain string.
+    :return: DB record or None if no live record exists.
+    """
+    started = perf_counter()
+    record = store.get(domain)
+    metrics.stage("backend", started, perf_counter())
+    if record is not None:
+        record_cache.put(domain, record, _record_ttl(record))
+    return record
+
+def _prefetch_ancestors(domain):
+    """
+    Fetch every ancestor of a domain up to domain.tld in a single batched request
+    and cache them, so walking up the tree to find the zone SOA needs no further round trips.
+    :param domain: IDNA domain string.
+    """
+    if snapshot is not None:
+        return
+    subdomain = suffixes.subdomain(domain)
+    depth = len(subdomain.split(".")) if subdomain != "" else 0
+    names = []
+    for name in [domain.lower().split(".", i)[i] for i in range(1, depth + 1)]:
+        found, _, _ = record_cache.peek(name) # Stale ancestors are revalidated one at a time.
+        if not found:
+            names.append(name)
+    if names != []:
+        try:
+            backend_flights.do((names[0], "ancestors"), lambda: _fetch_ancestors(names), timeout=BACKEND_WAIT)
+        except Exception:
+            logger.warning("Failed to prefetch the ancestors of " + domain)
+
+def _fetch_ancestors(names):
+    """
+    Fetch a list of ancestor domains in a single batched request and cache them.
+    :param names: Lowercase ancestor domains, closest first.
+    """
+    started = perf_counter()
+    unprocessed = []
+    items = store.batch_get(names, unprocessed)
+    metrics.stage("backend", started, perf_counter())
+    # Walk down from domain.tld so misses are cached for the SOA minimum of their closest enclosing zone.
+    # Below a name the backend gave up on the enclosing zone is unknown, so no misses are cached there.
+    ttl = NEGATIVE_TTL
+    for name in reversed(names):
+        if name in items:
+            record_cache.put(name, items[name], _record_ttl(items[name]))
+            if "SOA" in items[name]:
+                soa_record = items[name]["SOA"]
+                ttl = min(int(soa_record["ttl"]), int(soa_record["times"][4]))
+        elif name in unprocessed:
+            ttl = None
+        elif ttl is not None:
+            record_cache.put(name, None, ttl)
+
+def _record_ttl(record):
+    """
+    Find the time a DB record can be cached for, the lowest TTL of all its record types.
+    :param record: DB record.
+    :return: TTL in seconds.
+    """
+    ttls = [int(value["ttl"]) for value in record.values() if isinstance(value, dict) and "ttl" in value]
+    return min(ttls) if ttls != [] else NEGATIVE_TTL
+
+def _cache_miss(domain, auth_list):
+    """
+    Cache a domain with no live record for the SOA minimum TTL (RFC 2308).
+    :param domain: IDNA domain string.
+    :param auth_list: Authority list for the miss, holding the zone SOA if one was found.
+    """
+    ttl = NEGATIVE_TTL
+    for rr in auth_list:
+        if rr.rtype == dnslib.QTYPE.SOA:
+            ttl = min(rr.ttl, rr.rdata.times[4])
+            break
+    record_cache.put(domain.lower(), None, ttl)
+
+def _identify_record(record, q_type, lifetimes=None):
     """
     Given a db record and a query type this system will convert the DB record
     into a DNS record if one exists.
     :param record: DB record to convert.
     :param q_type: DNS Query type.
+    :param lifetimes: Optional list of record cache lifetimes, as in search.
     :return: Tuple of lists:
     rr_list = resource record list.
     auth_list = authorative list.
@@ -77,7 +354,7 @@ def _identify_record(record, q_type):
     if q_type == dnslib.QTYPE.SOA or q_type == dnslib.QTYPE.ANY:
         _soa_search(record, rr_list, auth_list, addi_list, authority=False) # SOA record search
     if rr_list == [] and auth_list == []:
-        _soa_search(record, rr_list, auth_list, addi_list, authority=True) # SOA record search
+        _soa_search(record, rr_list, auth_list, addi_list, authority=True, lifetimes=lifetimes) # SOA record search
     return rr_list, auth_list, addi_list
 
 def _a_search(record, rr_list, auth_list, addi_list):
@@ -185,7 +462,7 @@ def _mx_search(record, rr_list, auth_list, addi_list):
     except:
         pass
 
-def _soa_search(record, rr_list, auth_list, addi_list, authority):
+def _soa_search(record, rr_list, auth_list, addi_list, authority, lifetimes=None):
     """
     Searches and adds any SOA records for the domain.
     :param record: Overall record for domain
@@ -193,6 +470,7 @@ def _soa_search(record, rr_list, auth_list, addi_list, authority):
     :param auth_list: Authority list for the domain
     :param addi_list: Additional list for the domain
     :param authority: Add record to authority list or answer list.
+    :param lifetimes: Optional list of record cache lifetimes, as in search.
     """
     try:
         soa_record = record["SOA"]
@@ -212,8 +490,9 @@ def _soa_search(record, rr_list, auth_list, addi_list, authority):
             _add_authority(record["domain"], auth_list)
             _add_additional(addi_list)
     except:
+        _prefetch_ancestors(record["domain"])
         parent_domain = record["domain"].split(".", 1)[1:][0]
-        p_rr_list, _, _ = search(domain=parent_domain, q_type=dnslib.QTYPE.SOA)
+        p_rr_list, _, _ = search(domain=parent_domain, q_type=dnslib.QTYPE.SOA, lifetimes=lifetimes)
         auth_list.extend(p_rr_list)
 
 def _txt_search(record, rr_list, auth_list, addi_list):
@@ -321,16 +600,8 @@ def _alias_search(q_type, record, rr_list, auth_list, addi_list):
     """
     try:
         alias_record = record["ALIAS"]
-        ttl = int(alias_record["ttl"])
-        question = dnslib.DNSRecord.question(alias_record["domain"], qtype=dnslib.QTYPE[q_type])
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(1)
-        sock.bind(("", 0)) # Bind to any available IP and port.
-        sock.sendto(question.pack(), ("10.0.0.2", 53))
-        res = dnslib.DNSRecord.parse(sock.recv(4096))
-        sock.close()
-        for r in res.rr:
-            ip = str(r.rdata)
+        addresses, ttl = alias_resolver.resolve(alias_record["domain"], q_type, int(alias_record["ttl"]))
+        for ip in addresses:
             if q_type == dnslib.QTYPE.A:
                 rdata = dnslib.A(ip)
             elif q_type == dnslib.QTYPE.AAAA:
@@ -344,6 +615,52 @@ def _alias_search(q_type, record, rr_list, auth_list, addi_list):
     except:
         pass
 
+def record_rrs(record):
+    """
+    Convert every record type of a DB record into resource records, as sent in a zone transfer.
+    ALIAS records are resolved to the addresses of their target and the SOA record is
+    left out, as a transfer carries it at its start and end.
+    :param record: DB record to convert.
+    :return: Resource record list.
+    """
+    rr_list, auth_list, addi_list = [], [], []
+    _cname_search(record, rr_list, auth_list, addi_list)
+    if rr_list != []:
+        return rr_list
+    _ns_search(record, rr_list, addi_list)
+    if rr_list == [] and "SOA" in record:
+        _add_authority(record["domain"], rr_list) # Zone apexes without NS records use the UH DNS nameservers.
+    _a_search(record, rr_list, auth_list, addi_list)
+    _aaaa_search(record, rr_list, auth_list, addi_list)
+    _mx_search(record, rr_list, auth_list, addi_list)
+    _txt_search(record, rr_list, auth_list, addi_list)
+    _srv_search(record, rr_list, auth_list, addi_list)
+    _caa_search(record, rr_list, auth_list, addi_list)
+    _naptr_search(record, rr_list, auth_list, addi_list)
+    return rr_list
+
+def delegation_rrs(record):
+    """
+    Convert the NS records of a child zone apex into the delegation sent in its parent's zone transfer.
+    :param record: DB record of the child zone apex.
+    :return: NS resource record list, the UH DNS nameservers if the record has none.
+    """
+    rr_list = []
+    _ns_search(record, rr_list, [])
+    if rr_list == []:
+        _add_authority(record["domain"], rr_list)
+    return rr_list
+
+def soa_rr(record):
+    """
+    Convert the SOA of a zone apex DB record into a resource record.
+    :param record: DB record holding an SOA record.
+    :return: SOA resource record.
+    """
+    rr_list = []
+    _soa_search(record, rr_list, [], [], authority=False)
+    return rr_list[0]
+
 def _add_authority(domain, auth_list):
     """
     Given a domain and an authority set,
@@ -0,0 +1,60 @@
+import threading
+
+
+class _Call():
+    """
+    A call in flight, shared by every caller asking for the same key.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    """
+    Class to coalesce concurrent calls for the same key into a single call.
+    The first caller runs the function, later callers wait for and share its result or exception.
+    """
+
+    def __init__(self):
+        """
+        Constructor for the single flight class.
+        """
+        self.issued = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, timeout=None):
+        """
+        Run a function for a key unless a call for the same key is already in flight.
+        :param key: Key identifying the call.
+        :param function: Function to run, taking no arguments.
+        :param timeout: Seconds to wait for a call in flight before giving up (None waits forever).
+        :return: Result of the function.
+        :raises TimeoutError: If the call in flight did not finish within the timeout.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.issued += 1
+            else:
+                self.coalesced += 1
+        if leader:
+            try:
+                call.result = function()
+            except Exception as error:
+                call.error = error
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        elif not call.done.wait(timeout):
+            raise TimeoutError("Timed out waiting for " + str(key))
+        if call.error is not None:
+            raise call.error
+        return call.result
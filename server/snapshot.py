@@ -0,0 +1,170 @@
+import os, threading, time, logging
+from store import MmapStore, in_zone
+
+logger = logging.getLogger("DNS")
+
+
+class ZoneSnapshot():
+    """
+    Class to hold every live record of a record store in memory.
+    Lookups never touch the network, the index is refreshed in the background
+    and swapped atomically so readers always see a consistent view.
+    With several worker processes one refreshes from the store and publishes the index
+    as a compiled store file, which the others follow instead of querying the store themselves.
+    """
+
+    def __init__(self, store, interval=30):
+        """
+        Constructor for the zone snapshot class.
+        :param store: RecordStore to load records from.
+        :param interval: Seconds between background refreshes.
+        """
+        self.store = store
+        self.interval = interval
+        self.index = {}
+        self.loaded = 0
+        self.listeners = []
+        self.path = None
+        self._publishing = False
+        self._following = False
+        self._published = None
+        self._thread = None
+
+    def get(self, domain):
+        """
+        Fetch the live record for a domain.
+        :param domain: Lowercase IDNA domain string.
+        :return: DB record or None if no live record exists.
+        """
+        return self.index.get(domain)
+
+    def zone(self, apex):
+        """
+        Iterate over the live records of a zone, the apex and every domain below it.
+        :param apex: Lowercase IDNA domain string of the zone apex.
+        :return: Iterable of records.
+        """
+        return (record for domain, record in self.index.items() if in_zone(domain, apex))
+
+    def load(self):
+        """
+        Load the entire store into a new index and swap it in, if any record changed.
+        """
+        started = time.time()
+        index = {}
+        for item in self.store.iterate():
+            index[item["domain"].lower()] = item
+        self.loaded = started
+        if index == self.index:
+            logger.debug("Snapshot: no records changed")
+            return
+        self.index = index
+        self._changed()
+        logger.info("Snapshot: loaded " + str(len(index)) + " records")
+
+    def refresh(self):
+        """
+        Bring the index up to date, either by applying changed items on top of
+        a copy of the current index or by loading the entire store again.
+        A following snapshot reloads the published file instead, when it changed.
+        """
+        if self._following:
+            self._reload_published()
+            return
+        if not self.store.incremental or self.loaded == 0:
+            self.load()
+            return
+        started = time.time()
+        index = None
+        for item in self.store.iterate(changed_since=self.loaded):
+            domain = item["domain"].lower()
+            live = item.get("live") is True
+            if (self.index if index is None else index).get(domain) == (item if live else None):
+                continue # Already applied, e.g. seen again in the overlapping delta window.
+            if index is None:
+                index = dict(self.index)
+            if live:
+                index[domain] = item
+            else:
+                index.pop(domain, None)
+        if index is not None:
+            self.index = index
+            self._changed()
+        self.loaded = started
+
+    def publish(self, path):
+        """
+        Write the index to a compiled store file for following snapshots, now and after every change.
+        :param path: File to publish to, replaced atomically.
+        """
+        self.path = path
+        self._following = False
+        self._publishing = True
+        self._write_published()
+
+    def _write_published(self):
+        """
+        Write the current index to the published file.
+        """
+        MmapStore.compile(self.index.values(), self.path)
+        self._published = self._file_version()
+
+    def follow(self, path):
+        """
+        Refresh from a file published by another process's snapshot instead of from the store.
+        :param path: Published file.
+        """
+        self.path = path
+        self._publishing = False
+        self._following = True
+
+    def _file_version(self):
+        """
+        Identify the current version of the published file, a new file replaces it on every change.
+        :return: Tuple of inode and modification time.
+        """
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _reload_published(self):
+        """
+        Load the published file into a new index and swap it in, if it changed since last loaded.
+        """
+        version = self._file_version()
+        if version == self._published:
+            return
+        published = MmapStore(self.path)
+        try:
+            self.index = {record["domain"].lower(): record for record in published.iterate()}
+        finally:
+            published.close()
+        self._published = version
+        self._changed()
+
+    def _changed(self):
+        """
+        Notify listeners, such as caches derived from the records, that the index changed.
+        """
+        if self._publishing:
+            self._write_published()
+        for listener in self.listeners:
+            listener()
+
+    def start(self):
+        """
+        Start refreshing the index in the background.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        """
+        Refresh the index every interval, keeping the previous view on failure.
+        """
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Snapshot: refresh failed")
@@ -0,0 +1,362 @@
+import os, json, mmap, time, random, struct, logging
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+logger = logging.getLogger("DNS")
+# Most keys DynamoDB accepts in a single BatchGetItem request.
+BATCH_GET_KEYS = 100
+
+
+class RecordStore():
+    """
+    Interface for the record stores the server can answer from.
+    Records are dictionaries keyed by record type, as stored in the DynamoDB records table.
+    """
+
+    # Whether iterate supports changed_since.
+    incremental = False
+
+    def get(self, domain):
+        """
+        Fetch the live record for a domain.
+        :param domain: Lowercase IDNA domain string.
+        :return: Record or None if no live record exists.
+        """
+        raise NotImplementedError
+
+    def batch_get(self, domains, unprocessed=None):
+        """
+        Fetch the live records for several domains at once.
+        :param domains: List of lowercase IDNA domain strings.
+        :param unprocessed: Optional list, extended with the domains the backend gave up on,
+        which are missing from the result whether or not they have a live record.
+        :return: Dictionary of domain to record for every domain with a live record.
+        """
+        records = {}
+        for domain in domains:
+            record = self.get(domain)
+            if record is not None:
+                records[domain] = record
+        return records
+
+    def iterate(self, changed_since=None):
+        """
+        Iterate over the records in the store.
+        :param changed_since: Optional timestamp, when supported only records changed since then
+        are returned including ones no longer live so they can be removed.
+        :return: Iterable of records.
+        """
+        raise NotImplementedError
+
+    def zone(self, apex):
+        """
+        Iterate over the live records of a zone, the apex and every domain below it.
+        :param apex: Lowercase IDNA domain string of the zone apex.
+        :return: Iterable of records, read as they are consumed.
+        """
+        return (record for record in self.iterate() if in_zone(record["domain"].lower(), apex))
+
+    def reset(self):
+        """
+        Drop any connection to the backend, such as one inherited from the parent of a forked process,
+        so the next lookup opens its own.
+        """
+
+
+class DynamoDBStore(RecordStore):
+    """
+    Record store backed by the DynamoDB records table.
+    The connection is only made on first use.
+    """
+
+    def __init__(self, table_name="records", region="eu-west-2", segments=4, delta_attr=None,
+                 batch_rounds=5, backoff=0.05, max_backoff=1):
+        """
+        Constructor for the DynamoDB store class.
+        :param table_name: Name of the records table.
+        :param region: AWS region of the table.
+        :param segments: Number of parallel scan segments used when iterating.
+        :param delta_attr: Optional numeric attribute holding each item's last modified time,
+        used to only scan for changed items.
+        :param batch_rounds: Maximum number of BatchGetItem requests made for one batched lookup.
+        :param backoff: Seconds of the first backoff before retrying unprocessed keys, doubled every round.
+        :param max_backoff: Longest backoff in seconds.
+        """
+        self.table_name = table_name
+        self.region = region
+        self.segments = segments
+        self.delta_attr = delta_attr
+        self.batch_rounds = batch_rounds
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.incremental = delta_attr is not None
+        self._dynamodb = None
+        self._table = None
+
+    def _connect(self):
+        """
+        Connect to DynamoDB if not already connected.
+        :return: The records table.
+        """
+        if self._table is None:
+            import boto3
+            self._dynamodb = boto3.resource('dynamodb',
+                                            aws_access_key_id=os.environ["AWS_ACCESS_ID"],
+                                            aws_secret_access_key=os.environ["AWS_ACCESS_KEY"],
+                                            region_name=self.region)
+            self._table = self._dynamodb.Table(self.table_name)
+        return self._table
+
+    def reset(self):
+        # boto3 resources and their connection pools must not be shared between processes.
+        self._dynamodb = None
+        self._table = None
+
+    def get(self, domain):
+        from boto3.dynamodb.conditions import Key, Attr
+        # Search the database for all live records on the domain
+        items = self._connect().query(
+            KeyConditionExpression=Key('domain').eq(domain),
+            FilterExpression=Attr('live').eq(True)
+        )["Items"]
+        return items[0] if items != [] else None
+
+    def batch_get(self, domains, unprocessed=None):
+        # BatchGetItem takes at most BATCH_GET_KEYS keys, so longer lists are fetched in chunks.
+        self._connect()
+        records = {}
+        for start in range(0, len(domains), BATCH_GET_KEYS):
+            keys = self._batch_get_chunk(domains[start:start + BATCH_GET_KEYS], records)
+            if keys != []:
+                logger.warning("BatchGetItem left " + str(len(keys)) + " keys unprocessed after " +
+                               str(self.batch_rounds) + " requests")
+                if unprocessed is not None:
+                    unprocessed.extend(key["domain"] for key in keys)
+        return records
+
+    def _batch_get_chunk(self, domains, records):
+        """
+        Fetch the live records for up to BATCH_GET_KEYS domains with BatchGetItem.
+        Unprocessed keys mostly mean the table is throttling, so they are retried with capped
+        exponential backoff and full jitter, giving up with what was fetched after batch_rounds requests.
+        :param domains: List of lowercase IDNA domain strings.
+        :param records: Dictionary of domain to record, updated with every live record fetched.
+        :return: Keys still unprocessed when giving up.
+        """
+        request = {self.table_name: {"Keys": [{"domain": domain} for domain in domains]}}
+        for round in range(self.batch_rounds):
+            if round > 0:
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (round - 1))))
+            response = self._dynamodb.batch_get_item(RequestItems=request)
+            for item in response["Responses"].get(self.table_name, []):
+                if item.get("live") is True:
+                    records[item["domain"]] = item
+            request = response.get("UnprocessedKeys")
+            if not request:
+                return []
+        return request[self.table_name]["Keys"]
+
+    def iterate(self, changed_since=None):
+        from boto3.dynamodb.conditions import Attr
+        if changed_since is not None and self.delta_attr is not None:
+            filter_expression = Attr(self.delta_attr).gte(int(changed_since))
+        else:
+            filter_expression = Attr('live').eq(True)
+        table = self._connect()
+        with ThreadPoolExecutor(max_workers=self.segments) as pool:
+            pages = pool.map(lambda segment: self._scan_segment(table, filter_expression, segment),
+                             range(self.segments))
+            return [item for page in pages for item in page]
+
+    def zone(self, apex):
+        from boto3.dynamodb.conditions import Attr
+        # The table is only keyed by domain, so read the zone as a paginated scan
+        # for domains containing the apex, one page at a time.
+        kwargs = {"FilterExpression": Attr('live').eq(True) & Attr('domain').contains(apex)}
+        table = self._connect()
+        while True:
+            page = table.scan(**kwargs)
+            for item in page["Items"]:
+                if in_zone(item["domain"].lower(), apex):
+                    yield item
+            if "LastEvaluatedKey" not in page:
+                return
+            kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    def _scan_segment(self, table, filter_expression, segment):
+        """
+        Scan a single segment of the table, following pagination.
+        :param table: The records table.
+        :param filter_expression: Filter to apply to scanned items.
+        :param segment: Segment number to scan.
+        :return: List of matching items.
+        """
+        items = []
+        kwargs = {
+            "FilterExpression": filter_expression,
+            "Segment": segment,
+            "TotalSegments": self.segments
+        }
+        while True:
+            page = table.scan(**kwargs)
+            items.extend(page["Items"])
+            if "LastEvaluatedKey" not in page:
+                return items
+            kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+
+class MemoryStore(RecordStore):
+    """
+    Record store holding every record in a dictionary.
+    """
+
+    def __init__(self, records=()):
+        """
+        Constructor for the memory store class.
+        :param records: Iterable of records, only live records are kept.
+        """
+        self.records = {record["domain"].lower(): record for record in records if record.get("live") is True}
+
+    def get(self, domain):
+        return self.records.get(domain)
+
+    def iterate(self, changed_since=None):
+        return list(self.records.values())
+
+
+class MmapStore(RecordStore):
+    """
+    Record store reading a compiled, sorted file through mmap.
+    Opening is near instant and several processes share the same page cached data.
+    File layout: magic, record count, then an index of (key offset, key length, value length)
+    entries sorted by key, followed by each key and its JSON encoded record.
+    """
+
+    MAGIC = b"DNSSTOR1"
+    _COUNT = struct.Struct(">I")
+    _ENTRY = struct.Struct(">IHI")
+
+    def __init__(self, path):
+        """
+        Constructor for the mmap store class.
+        :param path: Path of a file built with MmapStore.compile.
+        """
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(path + " is not a compiled record store")
+        self.count = self._COUNT.unpack_from(self._map, len(self.MAGIC))[0]
+        self._index = len(self.MAGIC) + self._COUNT.size
+
+    def close(self):
+        """
+        Unmap the file.
+        """
+        self._map.close()
+
+    def _entry(self, position):
+        """
+        Read an index entry.
+        :param position: Position of the entry in the index.
+        :return: Tuple of key offset, key length and value length.
+        """
+        return self._ENTRY.unpack_from(self._map, self._index + position * self._ENTRY.size)
+
+    def _value(self, offset, key_length, value_length):
+        """
+        Decode the record stored after a key.
+        """
+        start = offset + key_length
+        return json.loads(self._map[start:start + value_length])
+
+    def get(self, domain):
+        key = domain.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset, key_length, value_length = self._entry(middle)
+            current = self._map[offset:offset + key_length]
+            if current == key:
+                return self._value(offset, key_length, value_length)
+            if current < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def iterate(self, changed_since=None):
+        for position in range(self.count):
+            yield self._value(*self._entry(position))
+
+    @classmethod
+    def compile(cls, records, path):
+        """
+        Write the live records to a compiled store file, replacing any existing file atomically.
+        :param records: Iterable of records.
+        :param path: Path of the file to write.
+        :return: Number of records written.
+        """
+        entries = sorted((record["domain"].lower().encode("utf-8"),
+                          json.dumps(record, default=_json_default, separators=(",", ":")).encode("utf-8"))
+                         for record in records if record.get("live") is True)
+        offset = len(cls.MAGIC) + cls._COUNT.size + len(entries) * cls._ENTRY.size
+        index, data = [], []
+        for key, value in entries:
+            index.append(cls._ENTRY.pack(offset, len(key), len(value)))
+            data.append(key + value)
+            offset += len(key) + len(value)
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as file:
+            file.write(cls.MAGIC + cls._COUNT.pack(len(entries)))
+            file.write(b"".join(index))
+            file.write(b"".join(data))
+        os.replace(temporary, path)
+        return len(entries)
+
+
+def in_zone(domain, apex):
+    """
+    Check whether a domain is a zone apex or below it.
+    :param domain: Lowercase IDNA domain string.
+    :param apex: Lowercase IDNA domain string of the zone apex.
+    :return: Whether the domain is in the zone.
+    """
+    return domain == apex or domain.endswith("." + apex)
+
+
+def _json_default(value):
+    """
+    Encode DynamoDB numbers as JSON numbers.
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, set):
+        return sorted(value)
+    raise TypeError(repr(value) + " is not JSON serializable")
+
+
+def load_json(path):
+    """
+    Load records from a JSON export, either a list of items or an object with an "Items" list.
+    :param path: Path of the JSON file.
+    :return: List of records.
+    """
+    with open(path) as file:
+        data = json.load(file)
+    return data["Items"] if isinstance(data, dict) else data
+
+
+def open_store(kind="dynamodb", path=None):
+    """
+    Open a record store.
+    :param kind: "dynamodb", "memory" (loaded from a JSON export) or "mmap" (a compiled store file).
+    :param path: Path of the JSON export or compiled store file.
+    :return: RecordStore instance.
+    """
+    if kind == "dynamodb":
+        return DynamoDBStore()
+    if kind == "memory":
+        return MemoryStore(load_json(path) if path is not None else ())
+    if kind == "mmap":
+        return MmapStore(path)
+    raise ValueError("Unknown record store " + kind)
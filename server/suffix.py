@@ -0,0 +1,113 @@
+"""
+Offline public suffix list lookups.
+Rules are read once from a local copy of the list, by default the snapshot bundled with tldextract,
+so nothing is ever downloaded and the lookup matches tldextract without importing it and its HTTP stack.
+Both the list syntax and the JSON array of rules that older tldextract releases (e.g. 2.2.0) ship are read.
+Usage: python suffix.py <compiled list> [public_suffix_list.dat] precompiles a list, IDNA encoding
+every rule ahead of time so loading it at startup is a plain read.
+"""
+import os, sys, json, importlib.util
+
+PRIVATE_MARKER = "===BEGIN PRIVATE DOMAINS==="
+
+
+def bundled_path():
+    """
+    Find the public suffix list snapshot shipped with tldextract, without importing the package.
+    :return: Path of the snapshot or None if tldextract is not installed.
+    """
+    spec = importlib.util.find_spec("tldextract")
+    if spec is None or spec.origin is None:
+        return None
+    return os.path.join(os.path.dirname(spec.origin), ".tld_set_snapshot")
+
+
+class PublicSuffixList():
+    """
+    Class to split domains into their subdomain, registered domain and public suffix.
+    Rules are stored IDNA encoded so lookups work directly on the IDNA domains of queries.
+    """
+
+    def __init__(self, rules=()):
+        """
+        Constructor for the public suffix list class.
+        :param rules: Iterable of rules in list syntax ("com", "*.ck", "!www.ck").
+        """
+        self.rules = set()
+        for rule in rules:
+            if not rule.isascii():
+                try:
+                    rule = rule.encode("idna").decode("ascii")
+                except UnicodeError:
+                    pass # Not IDNA 2003 encodable, no IDNA query can match it anyway.
+            self.rules.add(rule.lower())
+
+    @classmethod
+    def load(cls, path=None, private=False):
+        """
+        Read a public suffix list file, in list syntax or as a JSON array of rules.
+        :param path: List file, the tldextract snapshot when None.
+        :param private: Include the private domains section, like tldextract's include_psl_private_domains.
+        JSON snapshots only hold the ICANN section, so this has no effect on them.
+        :return: PublicSuffixList.
+        """
+        path = path or bundled_path()
+        if path is None:
+            raise FileNotFoundError("No public suffix list found, install tldextract or set DNS_SUFFIX_LIST")
+        with open(path, encoding="utf-8") as file:
+            text = file.read()
+        if text.lstrip().startswith("["):
+            return cls(json.loads(text))
+        rules = []
+        for line in text.splitlines():
+            line = line.strip()
+            if line.startswith("//"):
+                if not private and PRIVATE_MARKER in line:
+                    break
+                continue
+            if line != "":
+                rules.append(line.split()[0])
+        return cls(rules)
+
+    def save(self, path):
+        """
+        Write the rules, already IDNA encoded, as a list file that load reads back without encoding.
+        :param path: Output file.
+        :return: Number of rules written.
+        """
+        rules = sorted(rule for rule in self.rules if rule.isascii())
+        with open(path, "w", encoding="ascii") as file:
+            file.write("".join(rule + "\n" for rule in rules))
+        return len(rules)
+
+    def suffix_index(self, labels):
+        """
+        Find where the public suffix of a domain starts, with the same rule precedence as tldextract.
+        :param labels: Lowercase labels of the domain.
+        :return: Index of the first suffix label, len(labels) if no rule matches.
+        """
+        for i in range(len(labels)):
+            candidate = ".".join(labels[i:])
+            if "!" + candidate in self.rules:
+                return i + 1
+            if candidate in self.rules or "*." + ".".join(labels[i + 1:]) in self.rules:
+                return i
+        return len(labels)
+
+    def subdomain(self, domain):
+        """
+        Find the subdomain part of a domain, e.g. "www" for "www.example.co.uk.".
+        :param domain: IDNA domain string, with or without the trailing dot.
+        :return: Subdomain string, empty for registered domains, suffixes and IPv4 addresses.
+        """
+        labels = domain.rstrip(".").lower().split(".")
+        if len(labels) == 4 and all(label.isdigit() and int(label) < 256 for label in labels):
+            return ""
+        return ".".join(labels[:max(self.suffix_index(labels) - 1, 0)])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        sys.exit(__doc__.strip())
+    count = PublicSuffixList.load(sys.argv[2] if len(sys.argv) == 3 else None).save(sys.argv[1])
+    print("Compiled " + str(count) + " public suffix rules into " + sys.argv[1])
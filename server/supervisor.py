@@ -0,0 +1,112 @@
+import os, signal, time, logging
+
+logger = logging.getLogger("DNS")
+
+
+def _exit_worker(signum, frame):
+    """
+    Signal handler stopping a worker process cleanly.
+    """
+    raise SystemExit(0)
+
+
+class Supervisor():
+    """
+    Class to fork and look after a fixed number of worker processes.
+    Crashed workers are restarted and termination signals are passed on to every worker.
+    """
+
+    def __init__(self, target, processes, pin_cpus=False, grace=5, restart_delay=1):
+        """
+        Constructor for the supervisor class.
+        :param target: Function run in each worker process, given the worker number.
+        :param processes: Number of worker processes.
+        :param pin_cpus: Pin each worker to a single CPU.
+        :param grace: Seconds to wait for workers to exit on shutdown before killing them.
+        :param restart_delay: Seconds to wait before restarting a crashed worker.
+        """
+        self.target = target
+        self.processes = processes
+        self.pin_cpus = pin_cpus
+        self.grace = grace
+        self.restart_delay = restart_delay
+        self.workers = {}
+        self.stopping = False
+
+    def _spawn(self, slot):
+        """
+        Fork a new worker process for a slot.
+        :param slot: Worker number, used to choose the CPU to pin to.
+        """
+        pid = os.fork()
+        if pid != 0:
+            self.workers[pid] = slot
+            return
+        # Worker process.
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, _exit_worker)
+            signal.signal(signal.SIGINT, _exit_worker)
+            if self.pin_cpus:
+                cpus = sorted(os.sched_getaffinity(0))
+                os.sched_setaffinity(0, {cpus[slot % len(cpus)]})
+            self.target(slot)
+        except SystemExit:
+            pass
+        except BaseException:
+            logger.exception("Worker " + str(slot) + " failed")
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _stop(self, signum, frame):
+        """
+        Signal handler passing termination on to every worker.
+        """
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        """
+        Start every worker and supervise them until a termination signal is received.
+        """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for slot in range(self.processes):
+            self._spawn(slot)
+        while not self.stopping:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            slot = self.workers.pop(pid, None)
+            if slot is not None and not self.stopping:
+                logger.error("Worker " + str(slot) + " exited with status " + str(status) + ", restarting")
+                time.sleep(self.restart_delay)
+                self._spawn(slot)
+        self._shutdown()
+
+    def _shutdown(self):
+        """
+        Wait for every worker to exit, killing any still running after the grace period.
+        """
+        deadline = time.monotonic() + self.grace
+        while self.workers and time.monotonic() < deadline:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.1)
+            else:
+                self.workers.pop(pid, None)
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self.workers = {}
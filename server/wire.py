@@ -0,0 +1,97 @@
+import struct
+from collections import namedtuple
+
+# Decoded form of a plain DNS query.
+# edns is None without an OPT record, otherwise a tuple of (version, do, udp_len).
+Query = namedtuple("Query", ["id", "flags", "qname", "qtype", "qclass", "question_end", "edns"])
+
+_HEADER = struct.Struct(">HHHHHH")
+_QUESTION = struct.Struct(">HH")
+_OPT = struct.Struct(">HHBBHH")
+
+
+class FormatError(Exception):
+    """
+    Raised when a DNS message is malformed.
+    """
+
+
+def decode_query(data):
+    """
+    Decode the common case of a DNS query straight from the wire:
+    one uncompressed question and an optional OPT record.
+    :param data: binary data in the form of a DNS query.
+    :return: Query or None if the message needs the full parser.
+    :raises FormatError: If the message is malformed.
+    """
+    view = memoryview(data)
+    length = len(view)
+    if length < 12:
+        raise FormatError("Short header")
+    id, flags, qdcount, ancount, nscount, arcount = _HEADER.unpack_from(view)
+    if flags & 0xF800 or qdcount != 1 or ancount or nscount or arcount > 1:
+        return None  # Response, non standard opcode or unusual sections.
+    labels = []
+    offset = 12
+    while True:
+        if offset >= length:
+            raise FormatError("Truncated question")
+        label = view[offset]
+        if label == 0:
+            break
+        if label & 0xC0:
+            return None  # Compressed question name.
+        offset += label + 1
+        if offset > length:
+            raise FormatError("Truncated question")
+        labels.append(view[offset - label:offset].tobytes())
+    offset += 1
+    if offset + 4 > length:
+        raise FormatError("Truncated question")
+    qtype, qclass = _QUESTION.unpack_from(view, offset)
+    offset += 4
+    question_end = offset
+    edns = None
+    if arcount:
+        if offset + 11 > length:
+            raise FormatError("Truncated additional record")
+        if view[offset] != 0:
+            return None  # Additional record with an owner name.
+        rtype, udp_len, _, version, edns_flags, rdlength = _OPT.unpack_from(view, offset + 1)
+        if rtype != 41:
+            return None  # Other additional records (e.g. TSIG).
+        offset += 11 + rdlength
+        edns = (version, bool(edns_flags & 0x8000), udp_len)
+    if offset != length:
+        return None  # Trailing or truncated data.
+    qname = b".".join(labels).decode("ascii", "backslashreplace") + "."
+    return Query(id, flags, qname, qtype, qclass, question_end, edns)
+
+
+def format_error(data):
+    """
+    Build a FORMERR response to a malformed message without parsing it.
+    :param data: binary data in the form of a DNS message.
+    :return: Packed response or None if there is no transaction ID to reply to.
+    """
+    if len(data) < 3:
+        return None
+    # Keep the opcode and RD bit, set QR and an RCODE of 1 (FORMERR) with empty sections.
+    return b"".join((data[:2], bytes([0x80 | (data[2] & 0x79), 0x01]), bytes(8)))
+
+
+def truncated(data):
+    """
+    Build an empty response with TC set to a plain query, asking the client to retry over TCP.
+    :param data: binary data in the form of a DNS query.
+    :return: Packed response or None if the query is not a plain query.
+    """
+    try:
+        query = decode_query(data)
+    except FormatError:
+        return None
+    if query is None:
+        return None
+    # Keep the opcode and RD bit, set QR and TC with only the question section.
+    return b"".join((data[:2], bytes([0x82 | (data[2] & 0x79), 0x00]), b"\x00\x01", bytes(6),
+                     data[12:query.question_end]))
@@ -0,0 +1,327 @@
+import os, socket, random, logging, threading, ipaddress, dnslib
+from wire import decode_query, FormatError
+from search import record_rrs, delegation_rrs, soa_rr
+from store import in_zone
+
+logger = logging.getLogger("DNS")
+
+AXFR = dnslib.QTYPE.AXFR
+IXFR = dnslib.QTYPE.IXFR
+
+
+class ZoneTransfer():
+    """
+    Class to answer AXFR and IXFR queries over TCP, streaming zones from a record source
+    and sending NOTIFY messages to secondaries when a zone's SOA serial changes.
+    Records are read, converted and packed as a generator pipeline, so a zone is never held in memory.
+    Child zones are left out of their parent's transfer apart from their delegation NS records.
+    No record store keeps a change history, so IXFR is answered with a full transfer unless
+    the client is up to date, as allowed by RFC 1995.
+    """
+
+    def __init__(self, source, allow=(), notify=(), message_size=16384, notify_interval=60):
+        """
+        Constructor for the zone transfer class.
+        :param source: RecordStore or ZoneSnapshot to read zones from.
+        :param allow: Networks (strings or ipaddress networks) allowed to transfer zones.
+        :param notify: Addresses (host, port) of secondaries sent NOTIFY messages.
+        :param message_size: Approximate maximum size of each transfer message in bytes.
+        :param notify_interval: Seconds between checks of the SOA serials of transferred zones.
+        """
+        self.source = source
+        self.allow = [ipaddress.ip_network(network, strict=False) for network in allow]
+        self.notify = list(notify)
+        self.message_size = min(message_size, 65535)
+        self.notify_interval = notify_interval
+        self.transfers = 0
+        self.refused = 0
+        self.notified = 0
+        self._serials = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._reports = None
+
+    def allowed(self, client):
+        """
+        Check whether a client may transfer zones.
+        :param client: Client (address, port) tuple.
+        :return: Whether the client address is in an allowed network.
+        """
+        try:
+            address = ipaddress.ip_address(client[0])
+        except (TypeError, ValueError):
+            return False
+        return any(address in network for network in self.allow)
+
+    def messages(self, data, client):
+        """
+        Answer a zone transfer query.
+        :param data: binary data in the form of a DNS query.
+        :param client: Client (address, port) tuple.
+        :return: Generator of packed response messages, or None if the query is not a zone transfer.
+        The generator does every lookup as it is consumed, this call only parses the query.
+        """
+        try:
+            query = decode_query(data)
+        except FormatError:
+            return None
+        if query is not None and query.qtype not in (AXFR, IXFR):
+            return None # Plain query, IXFR queries carry an SOA so are never plain.
+        try:
+            request = dnslib.DNSRecord.parse(data)
+        except dnslib.DNSError:
+            return None
+        if len(request.questions) != 1 or request.q.qtype not in (AXFR, IXFR):
+            return None
+        return self._respond(request, client)
+
+    def _respond(self, request, client):
+        """
+        Generate the response messages to a zone transfer query.
+        :param request: Parsed transfer query.
+        :param client: Client (address, port) tuple.
+        :return: Generator of packed messages.
+        """
+        if not self.allowed(client):
+            self.refused += 1
+            logger.warning("Refused zone transfer of " + str(request.q.qname) + " to " + str(client[0]))
+            yield self._error(request, dnslib.RCODE.REFUSED)
+            return
+        try:
+            apex = request.q.qname.idna().lower()
+        except UnicodeError:
+            yield self._error(request, dnslib.RCODE.FORMERR)
+            return
+        record = self.source.get(apex)
+        if record is None or "SOA" not in record:
+            yield self._error(request, dnslib.RCODE.NOTAUTH)
+            return
+        soa = soa_rr(record)
+        self._track(apex, soa.rdata.times[0])
+        self.transfers += 1
+        if request.q.qtype == IXFR and self._client_serial(request) == soa.rdata.times[0]:
+            yield self._pack(request, [soa], first=True) # Already up to date.
+            return
+        yield from self._pack_messages(request, self._transfer_rrs(apex, soa))
+
+    def _client_serial(self, request):
+        """
+        Find the serial an IXFR client currently holds.
+        :param request: Parsed IXFR query.
+        :return: Serial from the SOA in the authority section or None.
+        """
+        for rr in request.auth:
+            if rr.rtype == dnslib.QTYPE.SOA:
+                return rr.rdata.times[0]
+        return None
+
+    def _transfer_rrs(self, apex, soa):
+        """
+        Generate the records of a zone transfer: the SOA, every other record in the zone, then the SOA again.
+        A child zone, a domain below the apex with its own SOA, is cut out of the transfer:
+        only the NS records delegating it are sent and every domain below it is left out.
+        :param apex: Lowercase IDNA domain string of the zone apex.
+        :param soa: SOA resource record of the zone.
+        :return: Generator of resource records.
+        """
+        yield soa
+        children = {} # Domain between the apex and a record to whether it is a child zone apex.
+        for record in self.source.zone(apex):
+            domain = record["domain"].lower()
+            if domain == apex:
+                yield from record_rrs(record)
+                continue
+            if "SOA" in record:
+                children[domain] = True
+            if self._below_cut(domain, apex, children):
+                continue
+            yield from delegation_rrs(record) if "SOA" in record else record_rrs(record)
+        yield soa
+
+    def _below_cut(self, domain, apex, children):
+        """
+        Check whether a domain is below a child zone apex, whatever order the zone is read in.
+        :param domain: Lowercase IDNA domain string below the zone apex.
+        :param apex: Lowercase IDNA domain string of the zone apex.
+        :param children: Dictionary of domains already looked up to whether they are a child zone apex,
+        updated with the ancestors of the domain.
+        :return: Whether the domain is in a child zone and not its apex.
+        """
+        name = domain.split(".", 1)[1]
+        while name != apex and in_zone(name, apex):
+            if name not in children:
+                record = self.source.get(name)
+                children[name] = record is not None and "SOA" in record
+            if children[name]:
+                return True
+            name = name.split(".", 1)[1]
+        return False
+
+    def _pack_messages(self, request, rrs):
+        """
+        Pack resource records into as few messages as fit the message size.
+        :param request: Parsed transfer query.
+        :param rrs: Iterable of resource records.
+        :return: Generator of packed messages.
+        """
+        batch, size, first = [], 0, True
+        for rr in rrs:
+            buffer = dnslib.DNSBuffer()
+            rr.pack(buffer)
+            length = len(buffer.data) # Uncompressed, so the packed message is never larger.
+            if batch != [] and size + length > self.message_size:
+                yield self._pack(request, batch, first)
+                batch, size, first = [], 0, False
+            batch.append(rr)
+            size += length
+        if batch != []:
+            yield self._pack(request, batch, first)
+
+    def _pack(self, request, rrs, first):
+        """
+        Pack a transfer message, only the first message repeats the question.
+        :param request: Parsed transfer query.
+        :param rrs: Resource records of the message.
+        :param first: Whether this is the first message of the transfer.
+        :return: Packed message.
+        """
+        return dnslib.DNSRecord(dnslib.DNSHeader(id=request.header.id, qr=1, aa=1, ra=0),
+                                questions=request.questions if first else [],
+                                rr=rrs).pack()
+
+    def _error(self, request, rcode):
+        """
+        Pack an error response to a transfer query.
+        :param request: Parsed transfer query.
+        :param rcode: Response code.
+        :return: Packed message.
+        """
+        return dnslib.DNSRecord(dnslib.DNSHeader(id=request.header.id, qr=1, ra=0, rcode=rcode),
+                                questions=request.questions).pack()
+
+    def share(self):
+        """
+        Share the transferred zones between worker processes, called before forking them.
+        Every worker reports the zones it transfers through a pipe to the one worker sending NOTIFY messages.
+        """
+        self._reports = os.pipe()
+        os.set_blocking(self._reports[1], False)
+
+    def _track(self, apex, serial):
+        """
+        Remember the serial a zone was first transferred at, reporting it to the notifying worker.
+        :param apex: Lowercase IDNA domain string of the zone apex.
+        :param serial: SOA serial sent in the transfer.
+        """
+        with self._lock:
+            if apex in self._serials:
+                return
+            self._serials[apex] = serial
+        if self._reports is not None:
+            try:
+                # Lines are far shorter than PIPE_BUF, so reports from several workers never interleave.
+                os.write(self._reports[1], (apex + " " + str(serial) + "\n").encode())
+            except OSError:
+                logger.warning("Failed to report the transfer of " + apex)
+
+    def changed(self):
+        """
+        Check the transferred zones for serial changes now, e.g. after the snapshot changed.
+        """
+        self._wake.set()
+
+    def start(self):
+        """
+        Start checking the SOA serials of transferred zones in the background,
+        sending NOTIFY messages to the secondaries when one changes.
+        With several worker processes only one may call this.
+        """
+        if self.notify != []:
+            if self._reports is not None:
+                threading.Thread(target=self._collect_reports, daemon=True).start()
+            threading.Thread(target=self._notify_loop, daemon=True).start()
+
+    def _collect_reports(self):
+        """
+        Track the zones transferred by every worker process, forever.
+        """
+        with os.fdopen(self._reports[0], "r", closefd=False) as reports:
+            for line in reports:
+                try:
+                    apex, serial = line.split()
+                    serial = int(serial)
+                except ValueError:
+                    continue
+                with self._lock:
+                    self._serials.setdefault(apex, serial)
+
+    def _notify_loop(self):
+        """
+        Check serials every interval or when woken, forever.
+        """
+        while True:
+            self._wake.wait(self.notify_interval)
+            self._wake.clear()
+            try:
+                self.check_serials()
+            except Exception:
+                logger.exception("Zone serial check failed")
+
+    def check_serials(self):
+        """
+        Send NOTIFY messages for every transferred zone whose SOA serial changed.
+        """
+        with self._lock:
+            serials = dict(self._serials)
+        for apex, serial in serials.items():
+            record = self.source.get(apex)
+            if record is None or "SOA" not in record:
+                continue
+            soa = soa_rr(record)
+            if soa.rdata.times[0] != serial:
+                with self._lock:
+                    self._serials[apex] = soa.rdata.times[0]
+                for secondary in self.notify:
+                    self._send_notify(apex, soa, secondary)
+
+    def _send_notify(self, apex, soa, secondary, attempts=3, timeout=1):
+        """
+        Send a NOTIFY message as per RFC 1996, retrying until it is acknowledged.
+        :param apex: Zone apex.
+        :param soa: Current SOA resource record of the zone.
+        :param secondary: Address (host, port) of the secondary.
+        :param attempts: Maximum number of messages sent.
+        :param timeout: Seconds to wait for each acknowledgement.
+        :return: Whether the NOTIFY was acknowledged.
+        """
+        message = dnslib.DNSRecord(dnslib.DNSHeader(id=random.getrandbits(16), opcode=dnslib.OPCODE.NOTIFY, aa=1),
+                                   q=dnslib.DNSQuestion(apex, dnslib.QTYPE.SOA), rr=[soa])
+        packet = message.pack()
+        with socket.socket(socket.AF_INET6 if ":" in secondary[0] else socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            for _ in range(attempts):
+                try:
+                    # Connected, so datagrams from any other source are never received.
+                    sock.connect(secondary)
+                    sock.send(packet)
+                    while True:
+                        if self._acknowledges(sock.recv(4096), message):
+                            self.notified += 1
+                            return True
+                except OSError:
+                    continue
+        logger.warning("NOTIFY for " + apex + " not acknowledged by " + str(secondary[0]))
+        return False
+
+    def _acknowledges(self, reply, message):
+        """
+        Check whether a reply acknowledges a NOTIFY message.
+        :param reply: Datagram received from the secondary.
+        :param message: NOTIFY message sent.
+        :return: Whether the reply is a NOTIFY response with the message ID.
+        """
+        try:
+            header = dnslib.DNSRecord.parse(reply).header
+        except dnslib.DNSError:
+            return False
+        return header.id == message.header.id and header.qr == 1 and header.opcode == dnslib.OPCODE.NOTIFY
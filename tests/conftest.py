@@ -0,0 +1,153 @@
+"""
+Shared test setup: the server modules are flat modules in server/, configured from the environment
+when first imported, so they are pointed at an empty memory store before any test imports them.
+"""
+import os, sys, socket, threading
+import dnslib, pytest
+
+os.environ.setdefault("DNS_STORE", "memory")
+os.environ.setdefault("DNS_QUERY_LOG", "off")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+
+class UpstreamStub():
+    """
+    Local UDP resolver answering every A or AAAA question with fixed addresses and TTL.
+    """
+
+    def __init__(self, addresses, ttl):
+        self.addresses = addresses
+        self.ttl = ttl
+        self.queries = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.address = self.sock.getsockname()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                data, client = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            self.queries += 1
+            request = dnslib.DNSRecord.parse(data)
+            reply = request.reply()
+            for address in self.addresses.get(request.q.qtype, []):
+                rdata = dnslib.A(address) if request.q.qtype == dnslib.QTYPE.A else dnslib.AAAA(address)
+                reply.add_answer(dnslib.RR(request.q.qname, request.q.qtype, rdata=rdata, ttl=self.ttl))
+            self.sock.sendto(reply.pack(), client)
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def upstream_stub():
+    """
+    Start an upstream stub, called with the addresses by query type and the TTL to answer with.
+    """
+    stubs = []
+
+    def start(addresses, ttl):
+        stub = UpstreamStub(addresses, ttl)
+        stubs.append(stub)
+        return stub
+    yield start
+    for stub in stubs:
+        stub.close()
+
+
+def _matches(condition, item):
+    """
+    Evaluate the boto3 conditions the record stores use against an item.
+    """
+    kind = type(condition).__name__
+    if kind == "And":
+        return all(_matches(part, item) for part in condition._values)
+    attribute, value = condition._values
+    field = item.get(attribute.name)
+    if kind == "Equals":
+        return field == value
+    if kind == "GreaterThanEquals":
+        return field is not None and field >= value
+    if kind == "Contains":
+        return field is not None and value in field
+    raise NotImplementedError(kind)
+
+
+class FakeTable():
+    """
+    In-memory stand-in for the DynamoDB records table, with paginated, segmented scans.
+    """
+
+    def __init__(self, items, page_size=2):
+        self.items = {item["domain"]: item for item in items}
+        self.page_size = page_size
+        self.scans = 0
+        self.queries = 0
+
+    def scan(self, FilterExpression=None, Segment=0, TotalSegments=1, ExclusiveStartKey=None):
+        self.scans += 1
+        domains = [domain for index, domain in enumerate(sorted(self.items)) if index % TotalSegments == Segment]
+        if ExclusiveStartKey is not None:
+            domains = [domain for domain in domains if domain > ExclusiveStartKey["domain"]]
+        page = domains[:self.page_size]
+        items = [self.items[domain] for domain in page
+                 if FilterExpression is None or _matches(FilterExpression, self.items[domain])]
+        response = {"Items": items}
+        if len(domains) > self.page_size:
+            response["LastEvaluatedKey"] = {"domain": page[-1]}
+        return response
+
+    def query(self, KeyConditionExpression, FilterExpression=None):
+        self.queries += 1
+        _, domain = KeyConditionExpression._values
+        item = self.items.get(domain)
+        matched = item is not None and (FilterExpression is None or _matches(FilterExpression, item))
+        return {"Items": [item] if matched else []}
+
+
+class FakeDynamoDB():
+    """
+    In-memory stand-in for the DynamoDB resource, returning every key of the first
+    throttled batch_get_item calls as unprocessed and any beyond per_request keys after that.
+    Like DynamoDB it rejects requests for more than 100 keys.
+    """
+
+    def __init__(self, table, table_name="records", throttled=0, per_request=None):
+        self.table = table
+        self.table_name = table_name
+        self.throttled = throttled
+        self.per_request = per_request
+        self.batches = 0
+
+    def batch_get_item(self, RequestItems):
+        self.batches += 1
+        keys = RequestItems[self.table_name]["Keys"]
+        if len(keys) > 100:
+            from botocore.exceptions import ClientError
+            raise ClientError({"Error": {"Code": "ValidationException",
+                                         "Message": "Too many items requested for the BatchGetItem call"}},
+                              "BatchGetItem")
+        if self.batches <= self.throttled:
+            return {"Responses": {}, "UnprocessedKeys": RequestItems}
+        keys, rest = keys[:self.per_request], keys[self.per_request:] if self.per_request else []
+        items = [self.table.items[key["domain"]] for key in keys if key["domain"] in self.table.items]
+        return {"Responses": {self.table_name: items},
+                "UnprocessedKeys": {self.table_name: {"Keys": rest}} if rest else {}}
+
+
+@pytest.fixture
+def dynamodb_store():
+    """
+    Connect a DynamoDBStore to an in-memory table, called with the items and store options.
+    """
+    from store import DynamoDBStore
+
+    def connect(items, throttled=0, per_request=None, **options):
+        store = DynamoDBStore(**options)
+        store._table = FakeTable(items)
+        store._dynamodb = FakeDynamoDB(store._table, store.table_name, throttled, per_request)
+        return store
+    return connect
@@ -0,0 +1,56 @@
+import time, dnslib
+import search
+from alias import AliasResolver
+import main
+from store import MemoryStore
+
+TARGET = "target.example.net."
+ADDRESSES = {dnslib.QTYPE.A: ["203.0.113.7"], dnslib.QTYPE.AAAA: ["2001:db8::7"]}
+
+
+def alias_record(ttl):
+    return {"domain": "example.com.", "live": True, "ALIAS": {"domain": TARGET, "ttl": ttl}}
+
+
+def test_resolve_returns_upstream_ttl_when_lower(upstream_stub):
+    stub = upstream_stub(ADDRESSES, ttl=5)
+    resolver = AliasResolver(upstream=stub.address)
+    assert resolver.resolve(TARGET, dnslib.QTYPE.A, 3600) == (["203.0.113.7"], 5)
+    addresses, ttl = resolver.resolve(TARGET, dnslib.QTYPE.A, 3600)
+    assert addresses == ["203.0.113.7"] and ttl <= 5
+    assert stub.queries == 1
+
+
+def test_resolve_returns_alias_ttl_when_lower(upstream_stub):
+    stub = upstream_stub(ADDRESSES, ttl=3600)
+    resolver = AliasResolver(upstream=stub.address)
+    assert resolver.resolve(TARGET, dnslib.QTYPE.AAAA, 60) == (["2001:db8::7"], 60)
+
+
+def test_cached_ttl_counts_down(upstream_stub, monkeypatch):
+    stub = upstream_stub(ADDRESSES, ttl=5)
+    resolver = AliasResolver(upstream=stub.address)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    resolver.resolve(TARGET, dnslib.QTYPE.A, 3600)
+    monkeypatch.setattr(time, "monotonic", lambda: now + 3)
+    assert resolver.resolve(TARGET, dnslib.QTYPE.A, 3600) == (["203.0.113.7"], 2)
+
+
+def test_alias_answer_and_answer_cache_use_upstream_ttl(upstream_stub, monkeypatch):
+    stub = upstream_stub(ADDRESSES, ttl=5)
+    monkeypatch.setattr(search, "alias_resolver", AliasResolver(upstream=stub.address))
+    monkeypatch.setattr(search, "store", MemoryStore([alias_record(3600)]))
+    search.record_cache.clear()
+    main.answer_cache.clear()
+    handler = main.TransportHandler(address=("127.0.0.1", 0))
+    try:
+        response = dnslib.DNSRecord.parse(handler._build_packet(dnslib.DNSRecord.question("example.com.").pack()))
+    finally:
+        handler.udp_sock.close()
+        handler.tcp_sock.close()
+    assert [(str(rr.rdata), rr.ttl) for rr in response.rr] == [("203.0.113.7", 5)]
+    keys = list(main.answer_cache._entries)
+    assert len(keys) == 1
+    found, _, remaining = main.answer_cache.peek(keys[0])
+    assert found and remaining <= 5
@@ -0,0 +1,37 @@
+import os
+import dnslib
+import search
+from alias import AliasResolver
+
+
+def test_forked_workers_get_their_own_alias_sockets(upstream_stub, monkeypatch):
+    stub = upstream_stub({dnslib.QTYPE.A: ["203.0.113.7"]}, ttl=300)
+    resolver = AliasResolver(upstream=stub.address, timeout=2, cache_entries=1)
+    monkeypatch.setattr(search, "alias_resolver", resolver)
+    resolver.resolve("warm.example.net.", dnslib.QTYPE.A, 300) # Leaves a pooled socket, as a warm-up does.
+    inherited = resolver._sockets.queue[0].getsockname()
+    children = []
+    for worker in range(4):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                search.reset_connections()
+                assert resolver._sockets.empty()
+                for name in range(20):
+                    resolver.cache.clear()
+                    addresses, _ = resolver.resolve("w%d-%d.example.net." % (worker, name), dnslib.QTYPE.A, 300)
+                    assert addresses == ["203.0.113.7"]
+                assert all(sock.getsockname() != inherited for sock in resolver._sockets.queue)
+                code = 0
+            finally:
+                os._exit(code)
+        children.append(pid)
+    assert [os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) for pid in children] == [0] * 4
+
+
+def test_reset_drops_the_dynamodb_connection(dynamodb_store):
+    store = dynamodb_store([{"domain": "example.com.", "live": True}])
+    assert store.get("example.com.") is not None
+    store.reset()
+    assert store._table is None and store._dynamodb is None
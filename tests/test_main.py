@@ -0,0 +1,164 @@
+import time, struct, logging, dnslib, pytest
+import search
+import main
+from store import MemoryStore
+
+APEX = {"domain": "example.com.", "live": True,
+        "SOA": {"ttl": 3600, "mname": "ns1.uh-dns.com.", "rname": "hostmaster.example.com.",
+                "times": [1, 7200, 3600, 1209600, 300]}}
+
+
+def a_record(domain, address, ttl=300):
+    return {"domain": domain, "live": True, "A": {"ttl": ttl, "value": [address]}}
+
+
+@pytest.fixture
+def handler():
+    search.record_cache.clear()
+    main.answer_cache.clear()
+    handler = main.TransportHandler(address=("127.0.0.1", 0))
+    yield handler
+    handler.udp_sock.close()
+    handler.tcp_sock.close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Set the monotonic clock the caches read, in seconds from the start of the test.
+    """
+    start = time.monotonic()
+
+    def set_time(seconds):
+        monkeypatch.setattr(time, "monotonic", lambda: start + seconds)
+    set_time(0)
+    return set_time
+
+
+def ask(handler, domain, q_type="A"):
+    return dnslib.DNSRecord.parse(handler._build_packet(dnslib.DNSRecord.question(domain, q_type).pack()))
+
+
+def test_answers_do_not_outlive_the_cached_record(handler, clock, monkeypatch):
+    store = MemoryStore([APEX, a_record("www.example.com.", "192.0.2.1")])
+    monkeypatch.setattr(search, "store", store)
+    search.search("www.example.com.", dnslib.QTYPE.A)
+    clock(1)
+    store.records["www.example.com."] = a_record("www.example.com.", "192.0.2.2")
+    clock(200)
+    assert [str(rr.rdata) for rr in ask(handler, "www.example.com.").rr] == ["192.0.2.1"]
+    clock(301)
+    assert [str(rr.rdata) for rr in ask(handler, "www.example.com.").rr] == ["192.0.2.2"]
+
+
+def test_negative_answers_do_not_outlive_the_cached_miss(handler, clock, monkeypatch):
+    store = MemoryStore([APEX])
+    monkeypatch.setattr(search, "store", store)
+    search.search("new.example.com.", dnslib.QTYPE.A)
+    store.records["new.example.com."] = a_record("new.example.com.", "192.0.2.3")
+    clock(250)
+    assert ask(handler, "new.example.com.").rr == []
+    clock(301)
+    assert [str(rr.rdata) for rr in ask(handler, "new.example.com.").rr] == ["192.0.2.3"]
+
+
+def header(id=0x1234, flags=0x0100, qdcount=1, arcount=0):
+    return struct.pack(">HHHHHH", id, flags, qdcount, 0, 0, arcount)
+
+
+def test_undecodable_names_are_format_errors_without_a_traceback(handler, caplog):
+    query = header() + b"\x07examp\xd2\x83\x03com\x00\x00\x01\x00\x01"
+    with caplog.at_level(logging.INFO, logger="DNS"):
+        response = dnslib.DNSRecord.parse(handler._build_packet(query))
+    assert response.header.rcode == dnslib.RCODE.FORMERR and response.header.id == 0x1234
+    assert response.rr == [] and len(response.questions) == 1
+    assert [record for record in caplog.records if record.levelno >= logging.WARNING] == []
+
+
+def test_backend_failures_are_server_failures(handler, caplog, monkeypatch):
+    class FailingStore(MemoryStore):
+        def get(self, domain):
+            raise RuntimeError("backend down")
+    monkeypatch.setattr(search, "store", FailingStore())
+    query = dnslib.DNSRecord.question("www.example.com.")
+    query.add_ar(dnslib.EDNS0(udp_len=1232))
+    with caplog.at_level(logging.INFO, logger="DNS"):
+        response = dnslib.DNSRecord.parse(handler._build_packet(query.pack()))
+    assert response.header.rcode == dnslib.RCODE.SERVFAIL
+    assert [rr.rtype for rr in response.ar] == [dnslib.QTYPE.OPT]
+    assert [record.getMessage() for record in caplog.records if record.exc_info] == ["Lookup failed"]
+
+
+def many_addresses(count):
+    return {"domain": "big.example.com.", "live": True,
+            "A": {"ttl": 300, "value": ["192.0.2.%d" % i for i in range(1, count + 1)]}}
+
+
+def big_response():
+    response = dnslib.DNSRecord(dnslib.DNSHeader(id=1, qr=1, aa=1, rd=1), q=dnslib.DNSQuestion("big.example.com."))
+    for rr in search._identify_record(many_addresses(10), dnslib.QTYPE.A)[0]:
+        response.add_answer(rr)
+    search._add_authority("big.example.com.", response.auth)
+    search._add_additional(response.ar)
+    response.add_ar(dnslib.EDNS0(udp_len=4096))
+    return response
+
+
+def test_size_limit(handler, monkeypatch):
+    assert handler._size_limit(None, False) == 512
+    assert handler._size_limit(100, False) == 512
+    assert handler._size_limit(1000, False) == 1000
+    assert handler._size_limit(4096, False) == 1232
+    assert handler._size_limit(None, True) == handler._size_limit(4096, True) == 65535
+    monkeypatch.setattr(main, "MAX_UDP_SIZE", 4096)
+    assert handler._size_limit(4096, False) == 4096
+
+
+def test_pack_drops_additional_then_authority_then_answer(handler):
+    full = big_response().pack()
+    response = big_response()
+    response.ar = [rr for rr in response.ar if rr.rtype == dnslib.QTYPE.OPT]
+    no_additional = len(response.pack())
+    response.auth = []
+    answer_only = len(response.pack())
+    assert len(full) > no_additional > answer_only
+    assert handler._pack(big_response(), len(full)) == full
+
+    packed = dnslib.DNSRecord.parse(handler._pack(big_response(), len(full) - 1))
+    assert len(packed.rr) == 10 and len(packed.auth) == 2
+    assert [rr.rtype for rr in packed.ar] == [dnslib.QTYPE.OPT] and packed.header.tc == 0
+
+    packed = dnslib.DNSRecord.parse(handler._pack(big_response(), no_additional - 1))
+    assert len(packed.rr) == 10 and packed.auth == [] and packed.header.tc == 0
+
+    packed = dnslib.DNSRecord.parse(handler._pack(big_response(), answer_only - 1))
+    assert packed.rr == [] and packed.auth == [] and packed.header.tc == 1
+    assert [rr.rtype for rr in packed.ar] == [dnslib.QTYPE.OPT] and len(packed.questions) == 1
+
+
+def query(domain, udp_len=None):
+    request = dnslib.DNSRecord.question(domain)
+    if udp_len is not None:
+        request.add_ar(dnslib.EDNS0(udp_len=udp_len))
+    return request.pack()
+
+
+def test_udp_answers_without_edns_fit_512_bytes(handler, monkeypatch):
+    monkeypatch.setattr(search, "store", MemoryStore([APEX, many_addresses(40)]))
+    packet = handler._build_packet(query("big.example.com."))
+    response = dnslib.DNSRecord.parse(packet)
+    assert len(packet) <= 512 and response.header.tc == 1 and response.rr == []
+    response = dnslib.DNSRecord.parse(handler._build_packet(query("big.example.com."), tcp=True))
+    assert response.header.tc == 0 and len(response.rr) == 40
+
+
+def test_udp_answers_are_capped_at_the_max_udp_size(handler, monkeypatch):
+    monkeypatch.setattr(search, "store", MemoryStore([APEX, many_addresses(100)]))
+    packet = handler._build_packet(query("big.example.com.", udp_len=4096))
+    response = dnslib.DNSRecord.parse(packet)
+    assert len(packet) <= 1232 and response.header.tc == 1 and response.rr == []
+    monkeypatch.setattr(main, "MAX_UDP_SIZE", 4096)
+    main.answer_cache.clear()
+    packet = handler._build_packet(query("big.example.com.", udp_len=4096))
+    response = dnslib.DNSRecord.parse(packet)
+    assert 1232 < len(packet) <= 4096 and response.header.tc == 0 and len(response.rr) == 100
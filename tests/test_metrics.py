@@ -0,0 +1,32 @@
+import re
+from metrics import Registry
+
+
+def buckets(text):
+    return [(match.group(1), int(match.group(2)))
+            for match in re.finditer(r'^dns_stage_seconds_bucket\{stage="parse",le="([^"]+)"\} (\d+)$', text, re.M)]
+
+
+def test_histograms_always_write_every_bucket():
+    registry = Registry()
+    registry.observe("dns_stage_seconds", (("stage", "parse"),), 0.0001)
+    first = buckets(registry.render())
+    for value in (0.000001, 0.003, 0.2, 3.0, 60.0):
+        registry.observe("dns_stage_seconds", (("stage", "parse"),), value)
+    second = buckets(registry.render())
+    assert [le for le, _ in first] == [le for le, _ in second]
+    assert first[-1][0] == "+Inf"
+    assert len(first) == len(registry.histograms[("dns_stage_seconds", (("stage", "parse"),))].counts)
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    for value in (0.000001, 0.0001, 0.0001, 0.003, 0.2, 60.0):
+        registry.observe("dns_stage_seconds", (("stage", "parse"),), value)
+    written = buckets(registry.render())
+    counts = [count for _, count in written]
+    assert counts == sorted(counts)
+    assert written[-1] == ("+Inf", 6)
+    # 60 s is over the highest finite bound, so only +Inf counts it.
+    assert written[-2][1] == 5 and float(written[-2][0]) < 60
+    assert dict(written)[repr(0.0001220703125)] >= 3
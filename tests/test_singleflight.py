@@ -0,0 +1,105 @@
+import threading, time
+import pytest
+import search
+from singleflight import SingleFlight
+from store import MemoryStore
+
+
+def run_together(count, function):
+    """
+    Call a function from several threads released at once.
+    :return: List of (result, error) tuples.
+    """
+    barrier = threading.Barrier(count)
+    results = []
+
+    def call():
+        barrier.wait()
+        try:
+            results.append((function(), None))
+        except Exception as error:
+            results.append((None, error))
+    threads = [threading.Thread(target=call) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def slow(result, calls, delay=0.2):
+    def function():
+        calls.append(True)
+        time.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return function
+
+
+def test_concurrent_calls_share_one_result():
+    flights, calls = SingleFlight(), []
+    results = run_together(20, lambda: flights.do("key", slow("value", calls), timeout=5))
+    assert results == [("value", None)] * 20
+    assert len(calls) == 1
+    assert flights.issued == 1 and flights.coalesced == 19
+
+
+def test_concurrent_calls_share_one_exception():
+    flights, calls = SingleFlight(), []
+    error = RuntimeError("backend failed")
+    results = run_together(10, lambda: flights.do("key", slow(error, calls), timeout=5))
+    assert [raised for _, raised in results] == [error] * 10
+    assert len(calls) == 1
+
+
+def test_different_keys_are_not_coalesced():
+    flights, calls = SingleFlight(), []
+    keys = iter(range(5))
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            key = next(keys)
+        return flights.do(key, slow(key, calls), timeout=5)
+    results = run_together(5, call)
+    assert sorted(result for result, _ in results) == list(range(5))
+    assert flights.issued == 5 and flights.coalesced == 0
+
+
+def test_waiters_give_up_after_the_timeout():
+    flights, calls = SingleFlight(), []
+    leader = threading.Thread(target=flights.do, args=("key", slow("value", calls, delay=0.5)))
+    leader.start()
+    while calls == []:
+        time.sleep(0.01)
+    with pytest.raises(TimeoutError):
+        flights.do("key", lambda: "other", timeout=0.05)
+    leader.join()
+    assert flights.do("key", lambda: "next") == "next" # Finished calls are not reused.
+
+
+class CountingStore(MemoryStore):
+    """
+    Memory store counting lookups, each taking a while like a DynamoDB query.
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.lookups = 0
+
+    def get(self, domain):
+        self.lookups += 1
+        time.sleep(0.2)
+        return super().get(domain)
+
+
+def test_cold_lookups_make_one_backend_query(monkeypatch):
+    store = CountingStore([{"domain": "www.example.com.", "A": {"ttl": 300, "value": ["192.0.2.1"]}, "live": True}])
+    monkeypatch.setattr(search, "store", store)
+    monkeypatch.setattr(search, "backend_flights", SingleFlight())
+    search.record_cache.clear()
+    results = run_together(50, lambda: search.search("www.example.com.", search.dnslib.QTYPE.A))
+    assert all(error is None and [str(rr.rdata) for rr in result[0]] == ["192.0.2.1"] for result, error in results)
+    assert store.lookups == 1
+    assert search.backend_flights.issued == 1 and search.backend_flights.coalesced == 49
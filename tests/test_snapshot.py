@@ -0,0 +1,207 @@
+import threading
+import pytest
+from snapshot import ZoneSnapshot
+from store import MemoryStore, RecordStore
+
+
+def item(domain, address, live=True, modified=0):
+    return {"domain": domain, "A": {"ttl": 300, "value": [address]}, "live": live, "modified": modified}
+
+
+class DeltaStore(RecordStore):
+    """
+    Store returning every item on a full iterate and only the queued changes when asked for changes.
+    """
+
+    incremental = True
+
+    def __init__(self, items):
+        self.items = items
+        self.changes = []
+        self.calls = []
+        self.error = None
+
+    def iterate(self, changed_since=None):
+        self.calls.append(changed_since)
+        if self.error is not None:
+            raise self.error
+        if changed_since is None:
+            return [item for item in self.items if item["live"] is True]
+        changes, self.changes = self.changes, []
+        return changes
+
+
+def test_load_indexes_live_records_by_lowercase_domain():
+    snapshot = ZoneSnapshot(MemoryStore([item("WWW.Example.com.", "192.0.2.1"),
+                                         item("old.example.com.", "192.0.2.2", live=False)]))
+    snapshot.load()
+    assert snapshot.get("www.example.com.")["A"]["value"] == ["192.0.2.1"]
+    assert snapshot.get("old.example.com.") is None
+    assert snapshot.loaded > 0
+
+
+def test_load_scans_every_segment_and_page(dynamodb_store):
+    items = [item("host%d.example.com." % i, "192.0.2.%d" % i, live=i % 5 != 0) for i in range(20)]
+    store = dynamodb_store(items, segments=3)
+    snapshot = ZoneSnapshot(store)
+    snapshot.load()
+    assert sorted(snapshot.index) == sorted(record["domain"] for record in items if record["live"])
+    assert store._table.scans > 3
+
+
+def test_refresh_without_deltas_reloads():
+    store = MemoryStore([item("a.example.com.", "192.0.2.1")])
+    snapshot = ZoneSnapshot(store)
+    snapshot.load()
+    store.records = {"b.example.com.": item("b.example.com.", "192.0.2.2")}
+    snapshot.refresh()
+    assert list(snapshot.index) == ["b.example.com."]
+
+
+def test_refresh_applies_updates_and_removals():
+    store = DeltaStore([item("a.example.com.", "192.0.2.1"), item("b.example.com.", "192.0.2.2")])
+    snapshot = ZoneSnapshot(store)
+    changes = []
+    snapshot.listeners.append(lambda: changes.append(True))
+    snapshot.refresh() # First refresh is a full load.
+    loaded = snapshot.loaded
+    store.changes = [item("a.example.com.", "198.51.100.1"), item("b.example.com.", "192.0.2.2", live=False),
+                     item("C.example.com.", "192.0.2.3")]
+    snapshot.refresh()
+    assert store.calls == [None, loaded]
+    assert snapshot.get("a.example.com.")["A"]["value"] == ["198.51.100.1"]
+    assert snapshot.get("b.example.com.") is None
+    assert snapshot.get("c.example.com.")["A"]["value"] == ["192.0.2.3"]
+    assert len(changes) == 2
+    snapshot.refresh() # Nothing changed, listeners are not called.
+    assert len(changes) == 2 and store.calls[-1] >= loaded
+
+
+def test_refresh_without_changes_keeps_the_index():
+    store = MemoryStore([item("a.example.com.", "192.0.2.1")])
+    snapshot = ZoneSnapshot(store)
+    changes = []
+    snapshot.listeners.append(lambda: changes.append(True))
+    snapshot.load()
+    before = snapshot.index
+    snapshot.refresh()
+    snapshot.refresh()
+    assert snapshot.index is before and len(changes) == 1
+    store.records["a.example.com."] = item("a.example.com.", "198.51.100.1")
+    snapshot.refresh()
+    assert snapshot.index is not before and len(changes) == 2
+
+
+def test_delta_refresh_of_applied_changes_keeps_the_index():
+    store = DeltaStore([item("a.example.com.", "192.0.2.1")])
+    snapshot = ZoneSnapshot(store)
+    changes = []
+    snapshot.listeners.append(lambda: changes.append(True))
+    snapshot.load()
+    before = snapshot.index
+    store.changes = [item("a.example.com.", "192.0.2.1"), item("gone.example.com.", "192.0.2.2", live=False)]
+    snapshot.refresh()
+    assert snapshot.index is before and len(changes) == 1
+
+
+def test_publisher_only_rewrites_the_file_on_changes(tmp_path):
+    path = tmp_path / "snapshot.db"
+    store = MemoryStore([item("a.example.com.", "192.0.2.1")])
+    publisher = ZoneSnapshot(store)
+    publisher.load()
+    publisher.publish(str(path))
+    version = publisher._file_version()
+    publisher.refresh()
+    assert publisher._file_version() == version
+
+
+def test_delta_refresh_on_dynamodb(dynamodb_store):
+    items = [item("a.example.com.", "192.0.2.1", modified=100), item("b.example.com.", "192.0.2.2", modified=100)]
+    store = dynamodb_store(items, segments=2, delta_attr="modified")
+    snapshot = ZoneSnapshot(store)
+    snapshot.load()
+    snapshot.loaded = 200
+    store._table.items["a.example.com."] = item("a.example.com.", "198.51.100.1", modified=250)
+    store._table.items["b.example.com."] = item("b.example.com.", "192.0.2.2", live=False, modified=250)
+    snapshot.refresh()
+    assert sorted(snapshot.index) == ["a.example.com."]
+    assert snapshot.get("a.example.com.")["A"]["value"] == ["198.51.100.1"]
+
+
+def test_refresh_swaps_in_a_new_index():
+    store = DeltaStore([item("a.example.com.", "192.0.2.1")])
+    snapshot = ZoneSnapshot(store)
+    snapshot.load()
+    before = snapshot.index
+    store.changes = [item("a.example.com.", "192.0.2.1", live=False), item("b.example.com.", "192.0.2.2")]
+    snapshot.refresh()
+    # Readers holding the previous view never see it change under them.
+    assert list(before) == ["a.example.com."]
+    assert snapshot.index is not before and list(snapshot.index) == ["b.example.com."]
+
+
+def test_failed_refresh_keeps_the_previous_view():
+    store = DeltaStore([item("a.example.com.", "192.0.2.1")])
+    snapshot = ZoneSnapshot(store)
+    snapshot.load()
+    before, loaded = snapshot.index, snapshot.loaded
+    store.error = RuntimeError("scan failed")
+    with pytest.raises(RuntimeError):
+        snapshot.refresh()
+    assert snapshot.index is before and snapshot.loaded == loaded
+
+
+def test_readers_see_whole_views_during_refreshes():
+    pairs = [item("a.example.com.", "192.0.2.1"), item("b.example.com.", "192.0.2.1")]
+    store = DeltaStore(pairs)
+    snapshot = ZoneSnapshot(store)
+    snapshot.load()
+    torn = []
+    stop = threading.Event()
+
+    def read():
+        while not stop.is_set():
+            index = snapshot.index
+            if index["a.example.com."]["A"] != index["b.example.com."]["A"]:
+                torn.append(index)
+    reader = threading.Thread(target=read)
+    reader.start()
+    for i in range(2000):
+        address = "198.51.100.%d" % (i % 250)
+        store.changes = [item("a.example.com.", address), item("b.example.com.", address)]
+        snapshot.refresh()
+    stop.set()
+    reader.join()
+    assert torn == []
+
+
+class UnusedStore(RecordStore):
+    """
+    Store of a following snapshot, which must never be read.
+    """
+
+    def iterate(self, changed_since=None):
+        raise AssertionError("following snapshots never read the store")
+
+
+def test_followers_load_published_refreshes_without_reading_the_store(tmp_path):
+    path = str(tmp_path / "snapshot.db")
+    store = DeltaStore([item("a.example.com.", "192.0.2.1"), item("b.example.com.", "192.0.2.2")])
+    publisher = ZoneSnapshot(store)
+    publisher.load()
+    publisher.publish(path)
+    follower = ZoneSnapshot(UnusedStore())
+    changes = []
+    follower.listeners.append(lambda: changes.append(True))
+    follower.follow(path)
+    follower.refresh()
+    assert sorted(follower.index) == ["a.example.com.", "b.example.com."]
+    follower.refresh() # Unchanged file, nothing reloaded.
+    assert len(changes) == 1
+    store.changes = [item("a.example.com.", "198.51.100.1"), item("b.example.com.", "192.0.2.2", live=False)]
+    publisher.refresh()
+    follower.refresh()
+    assert list(follower.index) == ["a.example.com."]
+    assert follower.get("a.example.com.")["A"]["value"] == ["198.51.100.1"]
+    assert len(changes) == 2
+    assert len(store.calls) == 2 # The initial load and one delta refresh, by the publisher only.
@@ -0,0 +1,85 @@
+import time
+import search
+from store import MemoryStore
+
+
+def records(count):
+    return [{"domain": "n%d.example.com." % i, "A": {"ttl": 300, "value": ["192.0.2.%d" % i]}, "live": True}
+            for i in range(count)]
+
+
+def domains(count):
+    return ["n%d.example.com." % i for i in range(count)]
+
+
+def test_batch_get_retries_unprocessed_keys_with_backoff(dynamodb_store, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    store = dynamodb_store(records(5), throttled=3, batch_rounds=5, backoff=0.05, max_backoff=0.1)
+    assert sorted(store.batch_get(domains(5))) == domains(5)
+    assert store._dynamodb.batches == 4
+    assert len(sleeps) == 3
+    assert all(0 <= sleep <= limit for sleep, limit in zip(sleeps, [0.05, 0.1, 0.1]))
+
+
+def test_batch_get_gives_up_with_what_was_fetched(dynamodb_store, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    store = dynamodb_store(records(5), per_request=2, batch_rounds=2)
+    unprocessed = []
+    assert sorted(store.batch_get(domains(5), unprocessed)) == domains(4)
+    assert unprocessed == ["n4.example.com."]
+    assert store._dynamodb.batches == 2 and len(sleeps) == 1
+
+
+def test_batch_get_under_sustained_throttling_is_bounded(dynamodb_store, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    store = dynamodb_store(records(3), throttled=1000, batch_rounds=6, backoff=0.05, max_backoff=1)
+    unprocessed = []
+    assert store.batch_get(domains(3), unprocessed) == {}
+    assert sorted(unprocessed) == domains(3)
+    assert store._dynamodb.batches == 6
+    assert max(sleeps) <= 1
+
+
+def test_batch_get_splits_long_key_lists(dynamodb_store):
+    store = dynamodb_store(records(250))
+    assert sorted(store.batch_get(domains(250))) == sorted(domains(250))
+    assert store._dynamodb.batches == 3
+
+
+def test_longest_names_prefetch_ancestors_in_batches(dynamodb_store, monkeypatch):
+    apex = {"domain": "example.com.", "live": True,
+            "SOA": {"ttl": 3600, "mname": "ns1.uh-dns.com.", "rname": "hostmaster.example.com.",
+                    "times": [1, 7200, 3600, 1209600, 300]}}
+    store = dynamodb_store([apex])
+    monkeypatch.setattr(search, "store", store)
+    search.record_cache.clear()
+    domain = "a." * 119 + "example.com."
+    _, auth_list, _ = search.search(domain, 1)
+    assert [rr.rtype for rr in auth_list] == [6]
+    assert store._dynamodb.batches == 2
+    assert store._table.queries == 1
+
+
+def test_batch_get_skips_records_that_are_not_live(dynamodb_store):
+    items = records(2)
+    items[1]["live"] = False
+    assert list(dynamodb_store(items).batch_get(domains(2))) == domains(1)
+
+
+def test_unprocessed_ancestors_are_not_cached_as_misses(monkeypatch):
+    class ThrottledStore(MemoryStore):
+        def batch_get(self, names, unprocessed=None):
+            unprocessed.append("b.example.com.")
+            return {"example.com.": self.records["example.com."]}
+    apex = {"domain": "example.com.", "live": True,
+            "SOA": {"ttl": 3600, "mname": "ns1.uh-dns.com.", "rname": "hostmaster.example.com.",
+                    "times": [1, 7200, 3600, 1209600, 300]}}
+    monkeypatch.setattr(search, "store", ThrottledStore([apex]))
+    search.record_cache.clear()
+    search._fetch_ancestors(["a.b.example.com.", "b.example.com.", "example.com."])
+    assert search.record_cache.get("example.com.") == (True, apex)
+    assert search.record_cache.get("b.example.com.") == (False, None)
+    assert search.record_cache.get("a.b.example.com.") == (False, None)
@@ -0,0 +1,52 @@
+import json
+import pytest
+from suffix import PublicSuffixList, bundled_path
+
+RULES = ["com", "uk", "co.uk", "*.ck", "!www.ck", "公司.hk", "hk"]
+
+
+def check(suffixes):
+    assert suffixes.subdomain("example.com.") == ""
+    assert suffixes.subdomain("www.example.com.") == "www"
+    assert suffixes.subdomain("a.b.example.co.uk.") == "a.b"
+    assert suffixes.subdomain("www.example.co.uk.") == "www"
+    assert suffixes.subdomain("co.uk.") == ""
+
+
+def test_loads_list_syntax(tmp_path):
+    path = tmp_path / "public_suffix_list.dat"
+    path.write_text("// ===BEGIN ICANN DOMAINS===\n" + "\n".join(RULES) +
+                    "\n// ===BEGIN PRIVATE DOMAINS===\nblogspot.com\n", encoding="utf-8")
+    suffixes = PublicSuffixList.load(str(path))
+    check(suffixes)
+    assert suffixes.subdomain("www.example.blogspot.com.") == "www.example"
+    assert PublicSuffixList.load(str(path), private=True).subdomain("www.example.blogspot.com.") == "www"
+
+
+def test_loads_json_snapshot(tmp_path):
+    # The layout of the .tld_set_snapshot shipped by tldextract 2.2.0.
+    path = tmp_path / ".tld_set_snapshot"
+    path.write_text(json.dumps(RULES, indent=2), encoding="utf-8")
+    suffixes = PublicSuffixList.load(str(path))
+    assert "com" in suffixes.rules and "xn--55qx5d.hk" in suffixes.rules
+    check(suffixes)
+    assert suffixes.subdomain("www.example.xn--55qx5d.hk.") == "www"
+    assert suffixes.subdomain("a.www.ck.") == "a"
+    assert suffixes.subdomain("a.example.other.ck.") == "a"
+
+
+def test_bundled_snapshot():
+    if bundled_path() is None:
+        pytest.skip("tldextract is not installed")
+    check(PublicSuffixList.load())
+
+
+def test_compiled_list_matches_the_snapshot(tmp_path):
+    if bundled_path() is None:
+        pytest.skip("tldextract is not installed")
+    suffixes = PublicSuffixList.load()
+    path = tmp_path / "public_suffix_list.dat"
+    assert suffixes.save(str(path)) > 1000
+    compiled = PublicSuffixList.load(str(path))
+    assert compiled.rules == {rule for rule in suffixes.rules if rule.isascii()}
+    check(compiled)
@@ -0,0 +1,137 @@
+import struct, dnslib, pytest
+import search
+import main
+from cache import AnswerCache
+from store import MemoryStore
+from wire import decode_query, format_error, truncated, FormatError
+
+QUESTION = b"\x03www\x07example\x03com\x00\x00\x01\x00\x01"
+
+
+def header(id=0x1234, flags=0x0100, qdcount=1, ancount=0, nscount=0, arcount=0):
+    return struct.pack(">HHHHHH", id, flags, qdcount, ancount, nscount, arcount)
+
+
+def opt(udp_len=1232, version=0, do=False, rdata=b""):
+    return b"\x00" + struct.pack(">HHBBHH", 41, udp_len, 0, version, 0x8000 if do else 0, len(rdata)) + rdata
+
+
+def test_decodes_plain_queries():
+    query = decode_query(header() + QUESTION)
+    assert (query.id, query.flags, query.qname, query.qtype, query.qclass) == \
+        (0x1234, 0x0100, "www.example.com.", 1, 1)
+    assert query.question_end == 12 + len(QUESTION) and query.edns is None
+
+
+def test_matches_dnslib():
+    data = dnslib.DNSRecord.question("Mixed.Example.com.", "AAAA").pack()
+    query = decode_query(data)
+    request = dnslib.DNSRecord.parse(data)
+    assert query.qname == str(request.q.qname) and query.qtype == request.q.qtype
+
+
+def test_extracts_opt_fields():
+    query = decode_query(header(arcount=1) + QUESTION + opt(udp_len=4096, do=True))
+    assert query.edns == (0, True, 4096)
+    query = decode_query(header(arcount=1) + QUESTION + opt(udp_len=512, version=1, rdata=b"\x00\x0a\x00\x00"))
+    assert query.edns == (1, False, 512)
+
+
+@pytest.mark.parametrize("data", [
+    b"\x12\x34\x01\x00",                                    # Short header.
+    header(),                                               # No question.
+    header() + b"\x07exam",                                 # Label past the end.
+    header() + b"\x03www\x07example\x03com",                # No root label.
+    header() + b"\x03www\x07example\x03com\x00\x00\x01",    # No class.
+    header(arcount=1) + QUESTION + b"\x00\x00\x29\x04",     # Short OPT record.
+])
+def test_truncated_messages_are_format_errors(data):
+    with pytest.raises(FormatError):
+        decode_query(data)
+
+
+@pytest.mark.parametrize("data", [
+    header(qdcount=2) + QUESTION + QUESTION,                            # Several questions.
+    header() + b"\x03www\xc0\x0c\x00\x01\x00\x01",                      # Compressed name.
+    header(flags=0x8100) + QUESTION,                                    # Response.
+    header(flags=0x2100) + QUESTION,                                    # UPDATE opcode.
+    header(ancount=1) + QUESTION,                                       # Answer section.
+    header(arcount=1) + QUESTION + b"\x03key\x00" + bytes(10),          # Named additional record.
+    header(arcount=1) + QUESTION + b"\x00\x00\xfa" + bytes(8),          # TSIG, not OPT.
+    header() + QUESTION + b"\x00",                                      # Trailing data.
+    header(arcount=1) + QUESTION + opt(rdata=b"\x00\x0a")[:-1],         # OPT data cut short.
+])
+def test_unusual_messages_fall_back_to_dnslib(data):
+    assert decode_query(data) is None
+
+
+def test_compressed_queries_are_answered_through_dnslib(monkeypatch):
+    monkeypatch.setattr(search, "store", MemoryStore([
+        {"domain": "www.example.com.", "live": True, "A": {"ttl": 300, "value": ["192.0.2.1"]}}]))
+    search.record_cache.clear()
+    main.answer_cache.clear()
+    handler = main.TransportHandler(address=("127.0.0.1", 0))
+    try:
+        # The second question name points back into the first for "example.com.".
+        data = header(qdcount=2) + QUESTION + b"\x03www\xc0\x10\x00\x01\x00\x01"
+        response = dnslib.DNSRecord.parse(handler._build_packet(data))
+    finally:
+        handler.udp_sock.close()
+        handler.tcp_sock.close()
+    assert [str(rr.rdata) for rr in response.rr] == ["192.0.2.1", "192.0.2.1"]
+    assert len(main.answer_cache) == 0
+
+
+def test_format_error_keeps_id_opcode_and_rd():
+    response = format_error(header(id=0xBEEF, flags=0x2100) + b"\x03ww")
+    assert len(response) == 12
+    id, flags, qdcount, ancount, nscount, arcount = struct.unpack(">HHHHHH", response)
+    assert id == 0xBEEF and flags == 0x8000 | 0x2000 | 0x0100 | 1
+    assert (qdcount, ancount, nscount, arcount) == (0, 0, 0, 0)
+    assert format_error(header(flags=0)[:3])[2] == 0x80
+    assert format_error(b"\x12\x34") is None
+
+
+def test_truncated_keeps_id_rd_and_question():
+    data = header(id=0xBEEF, flags=0x0100, arcount=1) + b"\x03WwW\x07example\x03com\x00\x00\x01\x00\x01" + opt()
+    response = dnslib.DNSRecord.parse(truncated(data))
+    assert response.header.id == 0xBEEF and response.header.qr == 1 and response.header.tc == 1
+    assert response.header.rd == 1 and response.header.opcode == 0 and response.header.aa == 0
+    assert str(response.q.qname) == "WwW.example.com." and response.rr == [] and response.ar == []
+    assert dnslib.DNSRecord.parse(truncated(header(flags=0) + QUESTION)).header.rd == 0
+    assert truncated(header() + b"\x07exam") is None
+    assert truncated(header(qdcount=2) + QUESTION + QUESTION) is None
+
+
+def test_answer_cache_copies_id_rd_and_question_case():
+    cache = AnswerCache()
+    first = dnslib.DNSRecord.question("www.example.com.")
+    reply = first.reply()
+    reply.add_answer(dnslib.RR("www.example.com.", rdata=dnslib.A("192.0.2.1"), ttl=300))
+    cache.put("key", reply.pack(), 300)
+    data = header(id=0xBEEF, flags=0) + b"\x03WWW\x07ExAmPlE\x03com\x00\x00\x01\x00\x01"
+    response = dnslib.DNSRecord.parse(cache.fetch("key", data, len(data)))
+    assert response.header.id == 0xBEEF and response.header.rd == 0 and response.header.qr == 1
+    assert str(response.q.qname) == "WWW.ExAmPlE.com."
+    assert [str(rr.rdata) for rr in response.rr] == ["192.0.2.1"]
+    assert cache.fetch("other", data, len(data)) is None
+
+
+def test_cached_answers_follow_each_query(monkeypatch):
+    monkeypatch.setattr(search, "store", MemoryStore([
+        {"domain": "www.example.com.", "live": True, "A": {"ttl": 300, "value": ["192.0.2.1"]}}]))
+    search.record_cache.clear()
+    main.answer_cache.clear()
+    handler = main.TransportHandler(address=("127.0.0.1", 0))
+    try:
+        handler._build_packet(header(id=1) + QUESTION)
+        hits = main.answer_cache.hits
+        data = header(id=2, flags=0) + b"\x03WWW\x07example\x03COM\x00\x00\x01\x00\x01"
+        response = dnslib.DNSRecord.parse(handler._build_packet(data))
+    finally:
+        handler.udp_sock.close()
+        handler.tcp_sock.close()
+    assert main.answer_cache.hits == hits + 1
+    assert response.header.id == 2 and response.header.rd == 0 and response.header.aa == 1
+    assert str(response.q.qname) == "WWW.example.COM."
+    assert [str(rr.rdata) for rr in response.rr] == ["192.0.2.1"]
@@ -0,0 +1,228 @@
+import os, time, socket, struct, threading
+import dnslib
+from store import MemoryStore
+from xfr import ZoneTransfer
+from main import TransportHandler
+from aio import AsyncTransportHandler
+
+CLIENT = ("127.0.0.1", 40000)
+
+
+def soa(apex, serial):
+    return {"ttl": 3600, "mname": "ns1.uh-dns.com.", "rname": "hostmaster." + apex, "times": [serial, 7200, 3600, 1209600, 300]}
+
+
+def zone_records():
+    # Below the cut first, so the child apex is only read after records it hides.
+    return [
+        {"domain": "deep.child.example.com.", "A": {"ttl": 300, "value": ["192.0.2.3"]}, "live": True},
+        {"domain": "example.com.", "SOA": soa("example.com.", 7),
+         "NS": {"ttl": 3600, "value": ["ns1.uh-dns.com.", "ns2.uh-dns.com."]}, "live": True},
+        {"domain": "www.example.com.", "A": {"ttl": 300, "value": ["192.0.2.1"]}, "live": True},
+        {"domain": "child.example.com.", "SOA": soa("child.example.com.", 3),
+         "NS": {"ttl": 3600, "value": ["ns.child.example.com."]},
+         "A": {"ttl": 300, "value": ["192.0.2.2"]}, "live": True},
+        {"domain": "a.b.example.com.", "TXT": {"ttl": 300, "value": ["empty non-terminal above"]}, "live": True},
+        {"domain": "example.org.", "SOA": soa("example.org.", 1), "live": True},
+    ]
+
+
+def transfer_query(apex, q_type="AXFR", serial=None):
+    query = dnslib.DNSRecord.question(apex, q_type)
+    if serial is not None:
+        query.add_auth(dnslib.RR(apex, dnslib.QTYPE.SOA, rdata=dnslib.SOA(times=(serial, 0, 0, 0, 0))))
+    return query.pack()
+
+
+def transfer(zone_transfer, apex, q_type="AXFR", serial=None, client=CLIENT):
+    return [dnslib.DNSRecord.parse(message) for message in
+            zone_transfer.messages(transfer_query(apex, q_type, serial), client)]
+
+
+def test_axfr_cuts_child_zones():
+    messages = transfer(ZoneTransfer(MemoryStore(zone_records()), allow=["127.0.0.0/8"]), "example.com.")
+    rrs = [rr for message in messages for rr in message.rr]
+    assert rrs[0].rtype == rrs[-1].rtype == dnslib.QTYPE.SOA
+    assert rrs[0].rdata.times[0] == 7
+    names = {(str(rr.rname), dnslib.QTYPE[rr.rtype]) for rr in rrs[1:-1]}
+    assert ("www.example.com.", "A") in names
+    assert ("a.b.example.com.", "TXT") in names
+    assert ("child.example.com.", "NS") in names
+    assert ("child.example.com.", "A") not in names
+    assert ("child.example.com.", "SOA") not in names
+    assert not any(name == "deep.child.example.com." for name, _ in names)
+    assert not any(name.endswith("example.org.") for name, _ in names)
+
+
+def test_child_zone_transfers_on_its_own():
+    messages = transfer(ZoneTransfer(MemoryStore(zone_records()), allow=["127.0.0.0/8"]), "child.example.com.")
+    names = {(str(rr.rname), dnslib.QTYPE[rr.rtype]) for message in messages for rr in message.rr}
+    assert ("deep.child.example.com.", "A") in names
+    assert ("child.example.com.", "A") in names
+
+
+def test_small_messages_split_the_transfer():
+    messages = transfer(ZoneTransfer(MemoryStore(zone_records()), allow=["127.0.0.0/8"], message_size=100),
+                        "example.com.")
+    assert len(messages) > 1
+    assert messages[0].questions != [] and all(message.questions == [] for message in messages[1:])
+
+
+def test_refused_outside_allowed_networks():
+    zone_transfer = ZoneTransfer(MemoryStore(zone_records()), allow=["10.0.0.0/8"])
+    [message] = transfer(zone_transfer, "example.com.")
+    assert message.header.rcode == dnslib.RCODE.REFUSED and message.rr == []
+    assert zone_transfer.refused == 1
+
+
+def test_notauth_without_soa():
+    [message] = transfer(ZoneTransfer(MemoryStore(zone_records()), allow=["127.0.0.0/8"]), "www.example.com.")
+    assert message.header.rcode == dnslib.RCODE.NOTAUTH
+
+
+def test_formerr_for_undecodable_apex():
+    zone_transfer = ZoneTransfer(MemoryStore(zone_records()), allow=["127.0.0.0/8"])
+    query = struct.pack(">HHHHHH", 1, 0, 1, 0, 0, 0) + b"\x07examp\xd2\x83\x03com\x00\x00\xfc\x00\x01"
+    [message] = [dnslib.DNSRecord.parse(message) for message in zone_transfer.messages(query, CLIENT)]
+    assert message.header.rcode == dnslib.RCODE.FORMERR
+
+
+def test_ixfr_up_to_date_gets_single_soa():
+    zone_transfer = ZoneTransfer(MemoryStore(zone_records()), allow=["127.0.0.0/8"])
+    [message] = transfer(zone_transfer, "example.com.", "IXFR", serial=7)
+    assert [dnslib.QTYPE[rr.rtype] for rr in message.rr] == ["SOA"]
+    messages = transfer(zone_transfer, "example.com.", "IXFR", serial=6)
+    assert sum(len(message.rr) for message in messages) > 2
+
+
+def test_plain_queries_are_not_transfers():
+    zone_transfer = ZoneTransfer(MemoryStore(zone_records()), allow=["127.0.0.0/8"])
+    assert zone_transfer.messages(dnslib.DNSRecord.question("example.com.", "A").pack(), CLIENT) is None
+
+
+class FailingStore(MemoryStore):
+    """
+    Memory store whose zone scan fails after the first few records.
+    """
+
+    def zone(self, apex):
+        for count, record in enumerate(super().zone(apex)):
+            if count == 3:
+                raise RuntimeError("scan failed")
+            yield record
+
+
+def test_transfer_failure_closes_connection():
+    records = zone_records() + [{"domain": "host%d.example.com." % i, "A": {"ttl": 300, "value": ["192.0.2.%d" % i]},
+                                 "live": True} for i in range(10, 20)]
+    handler = TransportHandler(address=("127.0.0.1", 0))
+    handler.transfer = ZoneTransfer(FailingStore(records), allow=["127.0.0.0/8"], message_size=64)
+    server = AsyncTransportHandler(handler, workers=2)
+    threading.Thread(target=server.run, kwargs={"udp": False}, daemon=True).start()
+    with socket.create_connection(handler.tcp_sock.getsockname(), timeout=5) as sock:
+        query = transfer_query("example.com.")
+        sock.sendall(struct.pack(">H", len(query)) + query)
+        received = b""
+        while True:
+            data = sock.recv(65535)
+            if data == b"":
+                break # Closed by the server rather than left open with half a zone.
+            received += data
+    assert len(received) > 0
+    messages = []
+    while received:
+        length = struct.unpack(">H", received[:2])[0]
+        messages.append(dnslib.DNSRecord.parse(received[2:2 + length]))
+        received = received[2 + length:]
+    rrs = [rr for message in messages for rr in message.rr]
+    assert rrs[0].rtype == dnslib.QTYPE.SOA
+    assert rrs[-1].rtype != dnslib.QTYPE.SOA or len(rrs) == 1
+
+
+class SecondaryStub():
+    """
+    Local UDP secondary answering each NOTIFY with the datagrams returned by replies(message),
+    sent from another socket when spoofed.
+    """
+
+    def __init__(self, replies, spoofed=False):
+        self.replies = replies
+        self.received = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.address = self.sock.getsockname()
+        self.source = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if spoofed else self.sock
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                data, client = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            message = dnslib.DNSRecord.parse(data)
+            self.received.append(message)
+            for reply in self.replies(message):
+                self.source.sendto(reply, client)
+
+
+def notify_ack(message):
+    reply = message.reply()
+    reply.header.opcode = dnslib.OPCODE.NOTIFY
+    return reply.pack()
+
+
+def test_notify_sent_when_serial_changes():
+    secondary = SecondaryStub(lambda message: [notify_ack(message)])
+    store = MemoryStore(zone_records())
+    zone_transfer = ZoneTransfer(store, allow=["127.0.0.0/8"], notify=[secondary.address])
+    transfer(zone_transfer, "example.com.")
+    zone_transfer.check_serials()
+    assert secondary.received == []
+    store.records["example.com."]["SOA"]["times"][0] = 8
+    zone_transfer.check_serials()
+    [message] = secondary.received
+    assert message.header.opcode == dnslib.OPCODE.NOTIFY and str(message.q.qname) == "example.com."
+    assert message.rr[0].rdata.times[0] == 8
+    assert zone_transfer.notified == 1
+
+
+def test_notify_ignores_replies_that_are_not_acks():
+    def replies(message):
+        query = dnslib.DNSRecord(dnslib.DNSHeader(id=message.header.id, opcode=dnslib.OPCODE.NOTIFY), q=message.q)
+        plain = message.reply()
+        plain.header.opcode = dnslib.OPCODE.QUERY
+        return [query.pack(), plain.pack()]
+    secondary = SecondaryStub(replies)
+    zone_transfer = ZoneTransfer(MemoryStore(zone_records()), notify=[secondary.address])
+    soa_record = transfer(ZoneTransfer(MemoryStore(zone_records()), allow=["127.0.0.0/8"]), "example.com.")[0].rr[0]
+    assert not zone_transfer._send_notify("example.com.", soa_record, secondary.address, attempts=1, timeout=0.2)
+    secondary.replies = lambda message: replies(message) + [notify_ack(message)]
+    assert zone_transfer._send_notify("example.com.", soa_record, secondary.address, attempts=1, timeout=1)
+
+
+def test_notify_ignores_acks_from_other_sources():
+    secondary = SecondaryStub(lambda message: [notify_ack(message)], spoofed=True)
+    zone_transfer = ZoneTransfer(MemoryStore(zone_records()), notify=[secondary.address])
+    soa_record = transfer(ZoneTransfer(MemoryStore(zone_records()), allow=["127.0.0.0/8"]), "example.com.")[0].rr[0]
+    assert not zone_transfer._send_notify("example.com.", soa_record, secondary.address, attempts=1, timeout=0.3)
+    assert len(secondary.received) == 1
+
+
+def test_workers_report_transfers_to_the_notifying_worker():
+    store = MemoryStore(zone_records())
+    zone_transfer = ZoneTransfer(store, allow=["127.0.0.0/8"], notify=[("127.0.0.1", 9)], notify_interval=3600)
+    zone_transfer.share()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            transfer(zone_transfer, "example.com.")
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert zone_transfer._serials == {}
+    zone_transfer.start()
+    deadline = time.monotonic() + 5
+    while zone_transfer._serials == {} and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert zone_transfer._serials == {"example.com.": 7}